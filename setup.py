@@ -17,15 +17,15 @@ setup(
         'Topic :: Home Automation',
         'Topic :: Internet',
         'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3 :: Only',
         'Programming Language :: Python :: 3.5',
         'Operating System :: POSIX :: Linux',
     ],
     keywords=['DreamScreen', 'BLE', 'Bluetooth Low Energy'],
     package_dir={'': 'src'},
     packages=['dsbtle'],
-    install_requires=['bluepy', 'parse'],
+    python_requires='>=3.5',
+    install_requires=['bluepy>=1.3.0'],
+    extras_require={'transition': ['numpy']},
 )
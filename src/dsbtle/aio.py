@@ -0,0 +1,229 @@
+''' asyncio front-end for DreamScreen '''
+import time
+import logging
+import asyncio
+from bluepy import btle
+from .dsbtle import *
+from .dsbtle import _helperFileno, _isDisconnect
+
+_log = logging.getLogger('dsbtle.aio')
+
+# Period of draining notifications, which were buffered by bluepy or arrived from connection without file descriptor
+DRAIN_INTERVAL = 0.05
+# Timeout of each non-blocking poll of the connection
+POLL_TIMEOUT = 0.001
+
+_GETTERS = {
+	'GetMode': Command.MODE,
+	'GetBrightness': Command.BRIGHTNESS,
+	'GetZone': Command.ZONE,
+	'GetAmblientColor': Command.AMBIENT_COLOR,
+	'GetSaturation': Command.SATURATION,
+	'GetSKU': Command.SKU,
+	'GetCustomLEDCount': Command.CUSTOM_LED_COUNT,
+	'GetMusicModeType': Command.MUSIC_MODE_TYPE,
+	'GetMusicModeColor': Command.MUSIC_MODE_COLOR,
+	'GetVideoMinimumIntensity': Command.VIDEO_MINIMUM_INTENSITY,
+	'GetAmbientShowType': Command.AMBIENT_SHOW_TYPE,
+	'GetFadeRate': Command.FADE_RATE,
+	'GetVersionNumber': Command.VERSION_NUMBER,
+	'GetMusicModeWeights': Command.MUSIC_MODE_WEIGHTS,
+}
+
+_SETTERS = ['SetMode', 'SetBrightness', 'SetZone', 'SetAmblientColor', 'SetSaturation', 'SetSKU', 'SetCustomLEDCount',
+	'SetMusicModeType', 'SetMusicModeColor', 'SetVideoMinimumIntensity', 'SetAmbientShowType', 'SetFadeRate', 'SetMusicModeWeights']
+
+class AsyncSubscription:
+	'''Awaitable view of Subscription, events may be published from any thread'''
+	def __init__(self, subscription, loop=None):
+		self.subscription = subscription
+		self.loop = loop if loop is not None else asyncio.get_event_loop()
+		self._ready = asyncio.Event()
+		subscription.callback = lambda: self.loop.call_soon_threadsafe(self._ready.set)
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		event = await self.Get()
+		if event is None:
+			raise StopAsyncIteration
+		return event
+
+	async def Get(self):
+		'''Return the next event, or None if closed'''
+		while True:
+			self._ready.clear()
+			event = self.subscription.Get(0)
+			if (event is not None) or self.subscription.closed:
+				return event
+			await self._ready.wait()
+
+	def Close(self):
+		self.subscription.Close()
+
+class AsyncDreamScreen:
+	'''Awaitable interface to DreamScreen, notifications are read by event loop'''
+	def __init__(self, dreamScreen, loop=None):
+		assert isinstance(dreamScreen, DreamScreen), 'dreamScreen must be DreamScreen: %r' % dreamScreen
+		_log.debug('AsyncDreamScreen.__init__')
+		self.dreamScreen = dreamScreen
+		self.loop = loop if loop is not None else asyncio.get_event_loop()
+		self._fileno = None
+		self._reconnects = None
+		# Future of Reconnect, which runs in executor
+		self._reconnecting = None
+		self._watch()
+		self._drainHandle = self.loop.call_later(DRAIN_INTERVAL, self._tick)
+
+	def Close(self):
+		_log.debug('AsyncDreamScreen.Close')
+		self._unwatch()
+		if self._drainHandle is not None:
+			self._drainHandle.cancel()
+			self._drainHandle = None
+
+	def _watch(self):
+		'''Watch output of bluepy-helper, which is restarted on reconnect (its descriptor may be reused)'''
+		self._unwatch()
+		self._reconnects = self.dreamScreen.reconnects
+		self._fileno = _helperFileno(self.dreamScreen.connection)
+		if self._fileno is not None:
+			self.loop.add_reader(self._fileno, self._drain)
+
+	def _unwatch(self):
+		if self._fileno is not None:
+			self.loop.remove_reader(self._fileno)
+			self._fileno = None
+
+	def _startReconnect(self):
+		'''Reconnect in executor, so backoff does not block the loop; return its future'''
+		if self._reconnecting is None:
+			_log.debug('AsyncDreamScreen: reconnect')
+			self._unwatch()
+			self._reconnecting = self.loop.run_in_executor(None, self.dreamScreen.Reconnect)
+			self._reconnecting.add_done_callback(self._reconnected)
+		return self._reconnecting
+
+	def _reconnected(self, future):
+		self._reconnecting = None
+		self._watch()
+
+	async def _call(self, function, *args, **kwargs):
+		'''Call blocking method of DreamScreen; dropped link is reconnected by _startReconnect and the call is repeated'''
+		while True:
+			if self._reconnecting is not None:
+				await asyncio.shield(self._reconnecting)
+			self.dreamScreen._deferReconnect.active = True
+			try:
+				return function(*args, **kwargs)
+			except btle.BTLEException as e:
+				if (self.dreamScreen._reconnect is None) or not _isDisconnect(e):
+					raise
+				_log.debug('AsyncDreamScreen: %s', e)
+			await asyncio.shield(self._startReconnect())
+
+	def _drain(self):
+		if (self.dreamScreen._reader is not None) or (self._reconnecting is not None):
+			# Notifications are read by the reader thread of DreamScreen, or the link is down
+			return
+		self.dreamScreen._deferReconnect.active = True
+		try:
+			while self.dreamScreen.WaitForNotifications(POLL_TIMEOUT):
+				pass
+		except btle.BTLEException as e:
+			_log.debug('AsyncDreamScreen._drain: %s', e)
+			if (self.dreamScreen._reconnect is not None) and _isDisconnect(e):
+				self._startReconnect()
+			else:
+				# Closed output would wake the loop forever; watched again after reconnect
+				self._unwatch()
+
+	def _tick(self):
+		if (self._reconnecting is None) and (self.dreamScreen.reconnects != self._reconnects):
+			# Reconnected by other thread
+			self._watch()
+		self._drain()
+		self._drainHandle = self.loop.call_later(DRAIN_INTERVAL, self._tick)
+
+	async def _quiet(self):
+		'''Sleep until the pause after write-command is over, so the next command does not block the loop in it'''
+		while True:
+			remaining = self.dreamScreen._quietUntil - time.time()
+			if remaining <= 0:
+				return
+			await asyncio.sleep(remaining)
+
+	async def ReadCommand(self, command, timeout=None):
+		'''Send read-command and return decoded value or None on timeout'''
+		await self._quiet()
+		if timeout is None:
+			timeout = self.dreamScreen.rtt.timeout
+		future = self.loop.create_future()
+		def resolve(request):
+			# Future may be cancelled by wait_for meanwhile
+			if not future.done():
+				future.set_result(request.response)
+		def complete(request):
+			# Called by the reader thread of DreamScreen, if it is running
+			self.loop.call_soon_threadsafe(resolve, request)
+		request = await self._call(self.dreamScreen.SubmitCommand, command, timeout, complete)
+		try:
+			response = await asyncio.wait_for(future, timeout)
+		except asyncio.TimeoutError:
+			self.dreamScreen._expire(request)
+			return None
+		return None if response is None else response.value
+
+	async def ReadCommands(self, commands, timeout=None):
+		'''Send all read-commands at once and return list of decoded values (None on timeout)'''
+		return await asyncio.gather(*[self.ReadCommand(command, timeout) for command in commands])
+
+	def Subscribe(self, commands=None, directions=None, maxsize=EVENT_QUEUE_SIZE, dropOldest=True):
+		'''Return AsyncSubscription to events of this DS'''
+		subscription = self.dreamScreen.events.Subscribe(commands, directions, [self.dreamScreen.address], maxsize, dropOldest)
+		return AsyncSubscription(subscription, self.loop)
+
+	async def SetName(self, name):
+		return await self._call(self.dreamScreen.SetName, name)
+
+	async def GetName(self):
+		return await self._call(self.dreamScreen.GetName)
+
+def _getter(name, command):
+	async def getter(self, timeout=None, fresh=False):
+		if not fresh:
+			value = self.dreamScreen.cache.Get(command)
+			if value is not None:
+				return value
+		return await self.ReadCommand(command, timeout)
+	getter.__name__ = name
+	return getter
+
+def _setter(name):
+	setter = getattr(DreamScreen, name)
+	command = _GETTERS['G' + name[1:]]
+	async def asyncSetter(self, *args, timeout=WRITE_TIMEOUT, force=False, delivery=None):
+		if delivery is None:
+			delivery = self.dreamScreen.delivery
+		if delivery != Delivery.FIRE_AND_FORGET:
+			await self._quiet()
+		# Validate and transmit without waiting, DS needs *timeout* pause before the next command of any coroutine
+		skippedWrites = self.dreamScreen.skippedWrites
+		await self._call(setter, self.dreamScreen, *args, timeout=timeout, force=force, delivery=Delivery.ACKED if delivery == Delivery.CONFIRMED else delivery)
+		if (self.dreamScreen.skippedWrites != skippedWrites) or (delivery == Delivery.FIRE_AND_FORGET):
+			return self
+		await self._quiet()
+		if delivery == Delivery.CONFIRMED:
+			value = self.dreamScreen.cache.Get(command)
+			# None after IDENTIFY mode, which can not be confirmed
+			if (value is not None) and (await self.ReadCommand(command) != value):
+				self.dreamScreen.unconfirmedWrites += 1
+		return self
+	asyncSetter.__name__ = name
+	return asyncSetter
+
+for (name, command) in _GETTERS.items():
+	setattr(AsyncDreamScreen, name, _getter(name, command))
+for name in _SETTERS:
+	setattr(AsyncDreamScreen, name, _setter(name))
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+
+''' DreamScreen micro-benchmarks '''
+import sys
+import json
+import time
+import timeit
+import logging
+import argparse
+from . import __version__
+from .dsbtle import *
+
+# Notifications as DS sends them: 20 bytes, real data before '\r'
+NOTIFICATIONS = [(response + b'\r').ljust(20, b'\0') for response in [
+	b'#Br1', b'#Cr050', b'#Dryyny', b'#Er255000010', b'#Fr255255255', b'#Gr0', b'#Hr010020a',
+	b'#Jr0', b'#Kr012', b'#Lr000000000', b'#Mr1', b'#Nr010', b'#Or0117', b'#Pr010010010']]
+
+def _parseDecodeResponse(data):
+	'''Reference decoder with ``parse`` library, as DreamScreenDefaultDelegate did before table-driven decoding'''
+	from parse import parse
+	response = data.split()[0].decode('UTF-8')
+	command = Command(response[1])
+	direction = CommandDirection(response[2])
+	argument = response[3:]
+	if command == Command.MODE:
+		value = Mode(parse('{:d}', argument)[0])
+	elif command in (Command.BRIGHTNESS, Command.FADE_RATE):
+		value = parse('{:d}', argument)[0]
+	elif command == Command.ZONE:
+		value = Zone(argument[0] == 'y', argument[1] == 'y', argument[2] == 'y', argument[3] == 'y')
+	elif command in (Command.AMBIENT_COLOR, Command.SATURATION, Command.VIDEO_MINIMUM_INTENSITY):
+		value = RGB(parse('{:d}', argument[0:3])[0], parse('{:d}', argument[3:6])[0], parse('{:d}', argument[6:])[0])
+	elif command == Command.SKU:
+		value = SKU(parse('{:d}', argument)[0])
+	elif command == Command.CUSTOM_LED_COUNT:
+		value = CustomLEDCount(parse('{:d}', argument[0:3])[0], parse('{:d}', argument[3:6])[0], CustomLEDMode(argument[6]))
+	elif command == Command.MUSIC_MODE_TYPE:
+		value = MusicModeType(parse('{:d}', argument)[0])
+	elif command == Command.MUSIC_MODE_COLOR:
+		value = MusicModeColors(*[MusicModeColor(parse('{:d}', argument[i])[0]) for i in range(3)])
+	elif command == Command.AMBIENT_SHOW_TYPE:
+		value = AmbientShowType(parse('{:d}', argument)[0])
+	elif command == Command.VERSION_NUMBER:
+		value = VersionNumber(parse('{:d}', argument[0:2])[0], parse('{:d}', argument[2:4])[0])
+	elif command == Command.MUSIC_MODE_WEIGHTS:
+		value = MusicModeWeights(parse('{:d}', argument[0:3])[0], parse('{:d}', argument[3:6])[0], parse('{:d}', argument[6:])[0])
+	return Response(command, direction, value)
+
+def BenchDecode(decode=DecodeResponse, rounds=2000):
+	'''Return decoded notifications per second'''
+	notifications = NOTIFICATIONS * rounds
+	def run():
+		for data in notifications:
+			decode(data)
+	return len(notifications) / min(timeit.repeat(run, number=1, repeat=3))
+
+def _formatFrame(command, direction, value):
+	'''Reference encoder: setter validation and string formatting, as DreamScreen did before precomputed frames'''
+	(red, green, blue) = value
+	assert (isinstance(red, int) and (red >= 0) and (red <= 255)), 'red must be int between 0 and 255: %r' % red
+	assert (isinstance(green, int) and (green >= 0) and (green <= 255)), 'green must be int between 0 and 255: %r' % green
+	assert (isinstance(blue, int) and (blue >= 0) and (blue <= 255)), 'blue must be int between 0 and 255: %r' % blue
+	argument = '%03d%03d%03d' % (red, green, blue)
+	assert isinstance(command, Command), 'command must be Commands: %r' % command
+	assert isinstance(direction, CommandDirection), 'direction must be CommandDirection: %r' % direction
+	assert isinstance(argument, str), 'argument must be string: %r' % argument
+	return ('%s%s%s%s' % (COMMAND_CHAR, command.value, direction.value, argument)).encode('UTF-8')
+
+def BenchEncode(encode=EncodeFrame, rounds=20000):
+	'''Return encoded AMBIENT_COLOR write-frames per second'''
+	(command, direction) = (Command.AMBIENT_COLOR, CommandDirection.WRITE)
+	colors = [RGB(i % 256, 255 - i % 256, i % 128) for i in range(rounds)]
+	def run():
+		for color in colors:
+			encode(command, direction, color)
+	return len(colors) / min(timeit.repeat(run, number=1, repeat=3))
+
+def _noDebug(log, red, green, blue):
+	pass
+
+def _eagerDebug(log, red, green, blue):
+	'''Call site as it was with DBG: message is formatted even if Debugging is off'''
+	DBG('SetAmblientColor(%d, %d, %d)' % (red, green, blue))
+
+def _lazyDebug(log, red, green, blue):
+	log.debug('SetAmblientColor(%d, %d, %d)', red, green, blue)
+
+def BenchLogging(rounds=100000):
+	'''Return overhead of disabled debug message per call (ns) at a typical call site: without message, DBG and logging'''
+	log = logging.getLogger('dsbtle.device.bench')
+	assert not log.isEnabledFor(logging.DEBUG), 'debug messages of dsbtle must be disabled'
+	results = OrderedDict()
+	for (name, function) in (('none', _noDebug), ('DBG', _eagerDebug), ('logging', _lazyDebug)):
+		seconds = min(timeit.repeat(lambda: function(log, 255, 0, 10), number=rounds, repeat=3))
+		results[name] = seconds / rounds * 1e9
+	return results
+
+def _report(name, rate, baseline=None):
+	print('%-32s %12.0f /s%s' % (name, rate, '' if baseline is None else '  x%.1f' % (rate / baseline)))
+
+def _percentile(samples, percent):
+	'''Nearest-rank percentile of sorted samples'''
+	if not samples:
+		return None
+	return samples[min(len(samples) - 1, max(0, int(round(percent / 100.0 * len(samples))) - 1))]
+
+def _measure(function, count):
+	'''Call function count times, return (sorted latencies of successful calls, number of timeouts, total time)'''
+	latencies = []
+	timeouts = 0
+	started = time.time()
+	for i in range(count):
+		start = time.time()
+		if function():
+			latencies.append(time.time() - start)
+		else:
+			timeouts += 1
+	return (sorted(latencies), timeouts, time.time() - started)
+
+def _stats(command, direction, measured):
+	(latencies, timeouts, total) = measured
+	count = len(latencies) + timeouts
+	return OrderedDict([
+		('command', command.name),
+		('direction', direction.name),
+		('count', count),
+		('timeouts', timeouts),
+		('timeoutRate', float(timeouts) / count if count else 0.0),
+		('p50', _percentile(latencies, 50)),
+		('p95', _percentile(latencies, 95)),
+		('p99', _percentile(latencies, 99)),
+		('commandsPerSecond', count / total if total else None),
+	])
+
+def _writeConfirmed(ds, command, frame, value, readTimeout, writeTimeout):
+	'''Write value, keep the pause of writeTimeout and read the value back; True if DS has it'''
+	ds._transmitWrite(command, frame, value, writeTimeout)
+	return ds._readCommandNWait(command, readTimeout, True) == value
+
+def BenchCommands(ds, count=50, readTimeout=READ_TIMEOUT, writeTimeout=WRITE_TIMEOUT):
+	'''Measure round trips of every read-command and of writing back the current value of every writable command
+
+	Write latency includes the pause after the write and read-back of the value; missing or other value counts as timeout.
+	Return list of statistics (dict) per command and direction; latencies are in seconds.
+	'''
+	results = []
+	snapshot = ds.Snapshot(readTimeout)
+	for command in Command:
+		results.append(_stats(command, CommandDirection.READ, _measure(lambda: ds._readCommandNWait(command, readTimeout, True) is not None, count)))
+	for (command, value) in snapshot.Writes():
+		if (command == Command.MODE) and (value == Mode.IDENTIFY):
+			continue
+		frame = EncodeFrame(command, CommandDirection.WRITE, value)
+		results.append(_stats(command, CommandDirection.WRITE, _measure(lambda: _writeConfirmed(ds, command, frame, value, readTimeout, writeTimeout), count)))
+	return results
+
+def BenchDelivery(ds, count=50):
+	'''Measure rate of AMBIENT_COLOR writes in every Delivery mode; fire-and-forget includes final VerifyWrites
+
+	Return list of statistics (dict) per mode.
+	'''
+	results = []
+	for delivery in Delivery:
+		(unconfirmedWrites, lostWrites) = (ds.unconfirmedWrites, ds.lostWrites)
+		started = time.time()
+		for i in range(count):
+			ds.SetAmblientColor(i % 256, 255 - i % 256, 0, force=True, delivery=delivery)
+		ds._pause(ds._quietUntil)
+		if delivery == Delivery.FIRE_AND_FORGET:
+			ds.VerifyWrites()
+		total = time.time() - started
+		results.append(OrderedDict([
+			('delivery', delivery.value),
+			('count', count),
+			('seconds', total),
+			('commandsPerSecond', count / total if total else None),
+			('unconfirmed', ds.unconfirmedWrites - unconfirmedWrites),
+			('lost', ds.lostWrites - lostWrites),
+		]))
+	return results
+
+def BenchReconnect(ds, connection, count=10):
+	'''Drop link of simulated DS count times, after writes of mode and ambient color (which switches mode), and reset its state
+
+	Measure reconnect with replay of desired state, done by the next read; count rounds, after which state of DS differs from desired one.
+	Return statistics (dict); latencies are in seconds.
+	'''
+	from .simulator import DEFAULT_STATE
+	ds.EnableReconnect(delay=0.01)
+	latencies = []
+	(timeouts, mismatches) = (0, 0)
+	for i in range(count):
+		color = RGB(i % 256, 0, 255 - i % 256)
+		ds.SetMode(Mode.VIDEO)
+		ds.SetAmblientColor(*color)
+		ds._pause(ds._quietUntil)
+		connection.disconnect()
+		# DS is reset, only replay restores its state
+		connection.state.update(DEFAULT_STATE)
+		start = time.time()
+		if ds.GetBrightness(fresh=True) is None:
+			timeouts += 1
+		latencies.append(time.time() - start)
+		ds._pause(ds._quietUntil)
+		if (connection.state[Command.AMBIENT_COLOR], connection.state[Command.MODE]) != (color, Mode.AMBIENT_STATIC):
+			mismatches += 1
+	latencies.sort()
+	return OrderedDict([
+		('count', count),
+		('reconnects', ds.reconnects),
+		('timeouts', timeouts),
+		('mismatches', mismatches),
+		('p50', _percentile(latencies, 50)),
+		('p95', _percentile(latencies, 95)),
+	])
+
+def _printCommandStats(results):
+	milliseconds = lambda value: '-' if value is None else '%.1f' % (value * 1000)
+	print('%-24s %-5s %6s %8s %8s %8s %8s %8s' % ('command', 'dir', 'count', 'timeouts', 'p50 ms', 'p95 ms', 'p99 ms', 'cmd/s'))
+	for result in results:
+		print('%-24s %-5s %6d %7.1f%% %8s %8s %8s %8.1f' % (result['command'], result['direction'], result['count'], result['timeoutRate'] * 100,
+			milliseconds(result['p50']), milliseconds(result['p95']), milliseconds(result['p99']), result['commandsPerSecond'] or 0))
+
+def _connect(args):
+	from bluepy import btle
+	if args.address:
+		return btle.Peripheral(args.address, args.addrType)
+	from .simulator import SimulatedDreamScreen
+	return SimulatedDreamScreen(latency=args.latency, jitter=args.jitter, loss=args.loss, seed=args.seed)
+
+def _decodeMain(args):
+	print('[!] Decode %d notifications x %d' % (len(NOTIFICATIONS), args.rounds))
+	try:
+		import parse
+		baseline = BenchDecode(_parseDecodeResponse, max(args.rounds // 10, 1))
+		_report('parse (reference)', baseline)
+	except ImportError:
+		baseline = None
+		print('[!] parse is not installed, reference decoder skipped')
+	_report('DecodeResponse', BenchDecode(DecodeResponse, args.rounds), baseline)
+
+def _encodeMain(args):
+	print('[!] Encode %d AMBIENT_COLOR frames' % args.rounds)
+	baseline = BenchEncode(_formatFrame, args.rounds)
+	_report('formatting (reference)', baseline)
+	_report('EncodeFrame', BenchEncode(EncodeFrame, args.rounds), baseline)
+	_report('EncodeFrameUnchecked', BenchEncode(EncodeFrameUnchecked, args.rounds), baseline)
+
+def _loggingMain(args):
+	print('[!] Disabled debug message x %d' % args.rounds)
+	results = BenchLogging(args.rounds)
+	for (name, overhead) in results.items():
+		print('%-32s %12.1f ns/call' % (name, overhead - results['none'] if name != 'none' else overhead))
+
+def _deliveryMain(args):
+	conn = _connect(args)
+	target = args.address or 'simulator (latency %.3f, jitter %.3f, loss %.3f)' % (args.latency, args.jitter, args.loss)
+	print('[!] Writes x %d on %s' % (args.count, target))
+	try:
+		results = BenchDelivery(DreamScreen(conn, DreamScreenDefaultDelegate()), args.count)
+	finally:
+		conn.disconnect()
+	print('%-16s %6s %8s %8s %11s %6s' % ('delivery', 'count', 'seconds', 'cmd/s', 'unconfirmed', 'lost'))
+	for result in results:
+		print('%-16s %6d %8.2f %8.1f %11d %6d' % (result['delivery'], result['count'], result['seconds'], result['commandsPerSecond'] or 0, result['unconfirmed'], result['lost']))
+
+def _reconnectMain(args):
+	from .simulator import SimulatedDreamScreen
+	conn = SimulatedDreamScreen(latency=args.latency, jitter=args.jitter, seed=args.seed)
+	print('[!] Reconnects x %d on simulator (latency %.3f, jitter %.3f)' % (args.count, args.latency, args.jitter))
+	try:
+		result = BenchReconnect(DreamScreen(conn, DreamScreenDefaultDelegate()), conn, args.count)
+	finally:
+		conn.disconnect()
+	print('%6s %10s %8s %10s %8s %8s' % ('count', 'reconnects', 'timeouts', 'mismatches', 'p50 ms', 'p95 ms'))
+	print('%6d %10d %8d %10d %8.1f %8.1f' % (result['count'], result['reconnects'], result['timeouts'], result['mismatches'], result['p50'] * 1000, result['p95'] * 1000))
+
+def _commandsMain(args):
+	conn = _connect(args)
+	target = args.address or 'simulator (latency %.3f, jitter %.3f, loss %.3f)' % (args.latency, args.jitter, args.loss)
+	print('[!] Commands x %d on %s' % (args.count, target))
+	try:
+		ds = DreamScreen(conn, DreamScreenDefaultDelegate())
+		results = BenchCommands(ds, args.count, args.readTimeout, args.writeTimeout)
+	finally:
+		conn.disconnect()
+	_printCommandStats(results)
+	if args.output:
+		with open(args.output, 'w') as output:
+			json.dump(OrderedDict([
+				('version', __version__),
+				('time', time.time()),
+				('target', target),
+				('count', args.count),
+				('readTimeout', args.readTimeout),
+				('writeTimeout', args.writeTimeout),
+				('results', results),
+				('metrics', ds.metrics.ToDict()),
+			]), output, indent=2)
+		print('[!] Results saved to %s' % args.output)
+
+def _addLinkArguments(parser):
+	parser.add_argument('--address', help='MAC of DS; simulator is used if omitted')
+	parser.add_argument('--addr-type', dest='addrType', default='public')
+	parser.add_argument('--latency', type=float, default=0.03, help='simulator link latency, seconds')
+	parser.add_argument('--jitter', type=float, default=0.01, help='simulator link jitter, seconds')
+	parser.add_argument('--loss', type=float, default=0.0, help='simulator frame loss probability')
+	parser.add_argument('--seed', type=int, default=1, help='simulator random seed')
+
+def main(argv):
+	parser = argparse.ArgumentParser(prog='python -m dsbtle.bench', description='DreamScreen benchmarks')
+	subparsers = parser.add_subparsers(dest='benchmark')
+	decode = subparsers.add_parser('decode', help='decoding rate of notifications')
+	decode.add_argument('rounds', type=int, nargs='?', default=2000)
+	decode.set_defaults(run=_decodeMain)
+	encode = subparsers.add_parser('encode', help='encoding rate of command frames')
+	encode.add_argument('rounds', type=int, nargs='?', default=20000)
+	encode.set_defaults(run=_encodeMain)
+	debug = subparsers.add_parser('logging', help='overhead of disabled debug messages')
+	debug.add_argument('rounds', type=int, nargs='?', default=100000)
+	debug.set_defaults(run=_loggingMain)
+	commands = subparsers.add_parser('commands', help='round trips of commands, on DS or simulator')
+	_addLinkArguments(commands)
+	commands.add_argument('--count', type=int, default=50, help='calls per command and direction')
+	commands.add_argument('--read-timeout', dest='readTimeout', type=float, default=READ_TIMEOUT)
+	commands.add_argument('--write-timeout', dest='writeTimeout', type=float, default=WRITE_TIMEOUT)
+	commands.add_argument('--output', help='save results to JSON file')
+	commands.set_defaults(run=_commandsMain)
+	delivery = subparsers.add_parser('delivery', help='rate of writes in every delivery mode, on DS or simulator')
+	_addLinkArguments(delivery)
+	delivery.add_argument('--count', type=int, default=50, help='writes per delivery mode')
+	delivery.set_defaults(run=_deliveryMain)
+	reconnect = subparsers.add_parser('reconnect', help='reconnect and replay of desired state, on simulator')
+	reconnect.add_argument('--count', type=int, default=10, help='dropped links')
+	reconnect.add_argument('--latency', type=float, default=0.03, help='simulator link latency, seconds')
+	reconnect.add_argument('--jitter', type=float, default=0.01, help='simulator link jitter, seconds')
+	reconnect.add_argument('--seed', type=int, default=1, help='simulator random seed')
+	reconnect.set_defaults(run=_reconnectMain)
+	args = parser.parse_args(argv)
+	if getattr(args, 'run', None) is None:
+		parser.print_help()
+		return
+	args.run(args)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
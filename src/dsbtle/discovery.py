@@ -0,0 +1,128 @@
+''' Discovery of DreamScreen devices by advertisements '''
+import logging
+import time
+import struct
+import threading
+from collections import deque, namedtuple
+from bluepy import btle
+from .dsbtle import *
+
+_log = logging.getLogger('dsbtle.discovery')
+
+DREAMSCREEN_NAME = 'DreamScreen'
+SCAN_TIMEOUT = 1.0
+# Period of yielding results by Stream
+SCAN_SLICE = 0.1
+
+# DS seen in advertisements: RSSI (dBm) and time of the last one
+Advertisement = namedtuple('Advertisement', 'address addrType rssi name connectable seen')
+
+_DS_SERVICE = btle.UUID(DS_SERVICE_UUID)
+_SERVICE_LISTS = (btle.ScanEntry.INCOMPLETE_16B_SERVICES, btle.ScanEntry.COMPLETE_16B_SERVICES,
+	btle.ScanEntry.INCOMPLETE_128B_SERVICES, btle.ScanEntry.COMPLETE_128B_SERVICES)
+
+def _localName(entry):
+	return entry.getValue(btle.ScanEntry.COMPLETE_LOCAL_NAME) or entry.getValue(btle.ScanEntry.SHORT_LOCAL_NAME)
+
+def IsDreamScreen(entry, manufacturerIds=()):
+	'''True if btle.ScanEntry advertises DS: by local name, ff60 service UUID or manufacturer data of given company IDs'''
+	name = _localName(entry)
+	if name and name.startswith(DREAMSCREEN_NAME):
+		return True
+	for tag in _SERVICE_LISTS:
+		if _DS_SERVICE in (entry.getValue(tag) or ()):
+			return True
+	manufacturer = entry.getValue(btle.ScanEntry.MANUFACTURER)
+	if manufacturerIds and manufacturer and (len(manufacturer) >= 2):
+		return struct.unpack('<H', manufacturer[:2])[0] in manufacturerIds
+	return False
+
+class _ScanDelegate(btle.DefaultDelegate):
+	def __init__(self, scanner):
+		btle.DefaultDelegate.__init__(self)
+		self.scanner = scanner
+
+	def handleDiscovery(self, entry, isNewDev, isNewData):
+		self.scanner._handleDiscovery(entry)
+
+class DreamScreenScanner:
+	'''Scanner, which finds DS by advertisements without connecting, and registry of DS it has seen'''
+	def __init__(self, iface=0, manufacturerIds=(), passive=False):
+		_log.debug('DreamScreenScanner.__init__')
+		self.iface = iface
+		self.manufacturerIds = frozenset(manufacturerIds)
+		self.passive = passive
+		self.scanner = btle.Scanner(iface).withDelegate(_ScanDelegate(self))
+		self.running = False
+		# Advertisement of every DS seen, by MAC
+		self.devices = {}
+		# DS seen for the first time, not yet yielded by Stream
+		self._new = deque()
+		self._lock = threading.Lock()
+
+	def _handleDiscovery(self, entry):
+		if not IsDreamScreen(entry, self.manufacturerIds):
+			return
+		advertisement = Advertisement(entry.addr, entry.addrType, entry.rssi, _localName(entry), entry.connectable, time.time())
+		with self._lock:
+			if entry.addr not in self.devices:
+				_log.debug('DreamScreenScanner: found %s (%d dB)', entry.addr, entry.rssi)
+				self._new.append(advertisement)
+			self.devices[entry.addr] = advertisement
+
+	def Start(self):
+		'''Start continuous scanning, results are processed by Scan and Stream'''
+		if not self.running:
+			self.scanner.start(passive=self.passive)
+			self.running = True
+		return self
+
+	def Stop(self):
+		if self.running:
+			self.scanner.stop()
+			self.running = False
+		return self
+
+	def Scan(self, timeout=SCAN_TIMEOUT):
+		'''Scan for timeout seconds, return list of DS seen in this scan, by RSSI (strongest first)'''
+		_log.debug('DreamScreenScanner.Scan(%s)', timeout)
+		started = time.time()
+		self._process(timeout)
+		return self.Devices(since=started)
+
+	def Stream(self, timeout=None):
+		'''Scan and yield Advertisement of every new DS as soon as it is seen, until timeout (None - forever)'''
+		_log.debug('DreamScreenScanner.Stream(%s)', timeout)
+		deadline = None if timeout is None else time.time() + timeout
+		while True:
+			with self._lock:
+				found = list(self._new)
+				self._new.clear()
+			for advertisement in found:
+				yield advertisement
+			remaining = SCAN_SLICE if deadline is None else min(SCAN_SLICE, deadline - time.time())
+			if remaining <= 0:
+				return
+			self._process(remaining)
+
+	def _process(self, timeout):
+		if self.running:
+			self.scanner.process(timeout)
+			return
+		self.Start()
+		try:
+			self.scanner.process(timeout)
+		finally:
+			self.Stop()
+
+	def Devices(self, since=None):
+		'''Return list of DS seen (since given time), by RSSI (strongest first)'''
+		with self._lock:
+			devices = [advertisement for advertisement in self.devices.values() if (since is None) or (advertisement.seen >= since)]
+		return sorted(devices, key=lambda advertisement: advertisement.rssi, reverse=True)
+
+	def Clear(self):
+		'''Forget all DS seen'''
+		with self._lock:
+			self.devices.clear()
+			self._new.clear()
@@ -1,11 +1,35 @@
 #!/usr/bin/env python
 
 ''' DreamScreen interface via BLE '''
+import os
 import sys
+import bisect
+import json
+import time
+import select
+import struct
+import logging
+import threading
+from collections import deque, namedtuple, OrderedDict
 from enum import Enum
 from bluepy import btle
-from parse import *
 
+# Loggers: dsbtle.core, dsbtle.device.<MAC> per DS and dsbtle.<module> for the other modules; messages are formatted
+# only when their level is enabled. Nothing is printed until the application configures logging
+_log = logging.getLogger('dsbtle.core')
+logging.getLogger('dsbtle').addHandler(logging.NullHandler())
+
+def SetLogLevel(level, address=None, subsystem=None):
+	'''Set level of all dsbtle loggers, or only of DS with given MAC, or only of subsystem (core, aio, fleet, stream, ...)'''
+	if address is not None:
+		name = 'dsbtle.device.%s' % address
+	elif subsystem is not None:
+		name = 'dsbtle.%s' % subsystem
+	else:
+		name = 'dsbtle'
+	logging.getLogger(name).setLevel(level)
+
+# Deprecated: formats its arguments eagerly and prints them, use logging instead
 Debugging = False
 def DBG(*args):
     if Debugging:
@@ -13,8 +37,31 @@ def DBG(*args):
         print(msg)
 
 COMMAND_CHAR = '#'
+DS_SERVICE_UUID = '0000ff60-0000-1000-8000-00805f9b34fb'
+DS_COMMAND_UUID = '0000ff61-0000-1000-8000-00805f9b34fb'
+DS_RESPONSE_UUID = '0000ff62-0000-1000-8000-00805f9b34fb'
+DS_NAME_UUID = '0000ff63-0000-1000-8000-00805f9b34fb'
 WRITE_TIMEOUT = 0.1
+# Period of read-back of fire-and-forget writes
+VERIFY_INTERVAL = 1.0
 READ_TIMEOUT = 1.0
+# Bounds of adaptive read timeout
+MIN_READ_TIMEOUT = 0.1
+MAX_READ_TIMEOUT = 4.0
+CACHE_TTL = None
+# Default bound of subscriber's event queue
+EVENT_QUEUE_SIZE = 256
+# Reader thread: period of checking for stop, longest hold of connection per poll, capacity of ring buffer
+READER_POLL = 0.05
+READER_SLICE = 0.002
+READER_BUFFER_SIZE = 1024
+# Automatic reconnect: attempts (None - forever), first delay between them and its bound, doubled after each attempt
+RECONNECT_ATTEMPTS = 8
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30.0
+HANDLE_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.dsbtle', 'handles.json')
+# Upper bounds of buckets of response latency histograms, seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
 
 class Command(Enum):
 	'''DreamScreen Commands'''
@@ -33,12 +80,17 @@ class Command(Enum):
 	VERSION_NUMBER = 'O'
 	MUSIC_MODE_WEIGHTS = 'P'
 
+	# Members are singletons: identity hash is consistent with equality and much faster than hash of name by Enum
+	__hash__ = object.__hash__
+
 class CommandDirection(Enum):
 	'''DreamScreen command direction'''
 	READ = 'r'
 	WRITE = 'w'
 	USER = 'u'
 
+	__hash__ = object.__hash__
+
 class Mode(Enum):
 	'''DreamScreen Modes'''
 	IDLE = 0
@@ -91,371 +143,1777 @@ class AmbientShowType(Enum):
 	POP = 7
 	ENCHANTED_FOREST = 8
 
+class Delivery(Enum):
+	'''Delivery of write-commands'''
+	CONFIRMED = 'confirmed'	# Write, pause, then read back the value
+	ACKED = 'acked'	# Write by command characteristic and keep pause before the next command
+	FIRE_AND_FORGET = 'fire-and-forget'	# Write to command handle without pause, read back later by VerifyWrites
+
+Response = namedtuple('Response', 'command direction value')
+Zone = namedtuple('Zone', 'top bottom left right')
+RGB = namedtuple('RGB', 'red green blue')
+CustomLEDCount = namedtuple('CustomLEDCount', 'vertical horizontal customLEDMode')
+MusicModeColors = namedtuple('MusicModeColors', 'treble middle bass')
+VersionNumber = namedtuple('VersionNumber', 'major minor')
+MusicModeWeights = namedtuple('MusicModeWeights', 'treble middle bass')
+
+# Argument field of a command: *width* characters, either integer between *minimum* and *maximum*
+# or one of *values* - Enum class or ``bool`` for 'y'/'n' flags
+Field = namedtuple('Field', 'name width minimum maximum values')
+
+def _intField(name, width, minimum, maximum):
+	return Field(name, width, minimum, maximum, None)
+
+def _enumField(name, enum):
+	return Field(name, 1, None, None, enum)
+
+def _rgbFields(maximum):
+	return tuple(_intField(name, 3, 0, maximum) for name in RGB._fields)
+
+# Argument layout of every command: record type (None for single value) and fields in order of transmission
+COMMAND_SCHEMA = {
+	Command.MODE: (None, (_enumField('mode', Mode),)),
+	Command.BRIGHTNESS: (None, (_intField('brightness', 3, 0, 100),)),
+	Command.ZONE: (Zone, tuple(_enumField(name, bool) for name in Zone._fields)),
+	Command.AMBIENT_COLOR: (RGB, _rgbFields(255)),
+	Command.SATURATION: (RGB, _rgbFields(255)),
+	Command.SKU: (None, (_enumField('sku', SKU),)),
+	Command.CUSTOM_LED_COUNT: (CustomLEDCount, (_intField('vertical', 3, 8, 32), _intField('horizontal', 3, 14, 60), _enumField('customLEDMode', CustomLEDMode))),
+	Command.MUSIC_MODE_TYPE: (None, (_enumField('musicModeType', MusicModeType),)),
+	Command.MUSIC_MODE_COLOR: (MusicModeColors, tuple(_enumField(name, MusicModeColor) for name in MusicModeColors._fields)),
+	Command.VIDEO_MINIMUM_INTENSITY: (RGB, _rgbFields(50)),
+	Command.AMBIENT_SHOW_TYPE: (None, (_enumField('ambientShowType', AmbientShowType),)),
+	Command.FADE_RATE: (None, (_intField('fadeRate', 3, 4, 50),)),
+	Command.VERSION_NUMBER: (VersionNumber, (_intField('major', 2, 0, 99), _intField('minor', 2, 0, 99))),
+	Command.MUSIC_MODE_WEIGHTS: (MusicModeWeights, tuple(_intField(name, 3, 5, 25) for name in MusicModeWeights._fields)),
+}
+
+def _compileField(field, start, last):
+	# (name, start, end, parseInt, lookup, minimum, maximum); the last field takes the rest of the argument
+	end = None if last else start + field.width
+	if field.values is None:
+		return (field.name, start, end, True, None, field.minimum, field.maximum)
+	if field.values is bool:
+		return (field.name, start, end, False, {'y': True, 'n': False}, None, None)
+	lookup = dict((item.value, item) for item in field.values)
+	return (field.name, start, end, all(isinstance(value, int) for value in lookup), lookup, None, None)
+
+def _compileDecoder(command, record, fields):
+	compiled = []
+	start = 0
+	for index, field in enumerate(fields):
+		compiled.append(_compileField(field, start, index == len(fields) - 1))
+		start += field.width
+	return (command, record, tuple(compiled))
+
+_DECODERS = dict((command.value.encode('UTF-8'), _compileDecoder(command, record, fields)) for (command, (record, fields)) in COMMAND_SCHEMA.items())
+_RESPONSE_DIRECTIONS = {CommandDirection.READ.value.encode('UTF-8'): CommandDirection.READ, CommandDirection.USER.value.encode('UTF-8'): CommandDirection.USER}
+_COMMAND_BYTE = COMMAND_CHAR.encode('UTF-8')
+
+def DecodeResponse(data):
+	'''Decode notification data to Response record'''
+	response = data.split(None, 1)[0]
+	assert (len(response) > 3), 'response length must be greather than 3: %r (%d)' % (response, len(response))
+	assert (response[0:1] == _COMMAND_BYTE), 'response must start with %s: %r' % (COMMAND_CHAR, response[0:1])
+
+	decoder = _DECODERS.get(response[1:2])
+	assert (decoder is not None), 'command is not recognised: %r' % response[1:2]
+	direction = _RESPONSE_DIRECTIONS.get(response[2:3])
+	assert (direction is not None), 'command direction is not recognised: %r' % response[2:3]
+
+	return Response(decoder[0], direction, _decodeArgument(decoder, response[3:].decode('UTF-8')))
+
+def DecodeArgument(command, argument):
+	'''Decode argument (str) of command to value'''
+	return _decodeArgument(_DECODERS[command.value.encode('UTF-8')], argument)
+
+def _decodeArgument(decoder, argument):
+	(command, record, fields) = decoder
+	values = []
+	for (name, start, end, parseInt, lookup, minimum, maximum) in fields:
+		value = argument[start:end]
+		if parseInt:
+			try:
+				value = int(value)
+			except ValueError:
+				assert False, '%s must be int: %r' % (name, argument)
+		if lookup is not None:
+			value = lookup.get(value)
+			assert (value is not None), '%s is not recognised: %r' % (name, argument)
+		else:
+			assert (minimum <= value <= maximum), '%s must be int between %d and %d: %r' % (name, minimum, maximum, value)
+		values.append(value)
+	return values[0] if record is None else record(*values)
+
+def _compileFields(lookups, kinds=None):
+	# Encoder of record value: concatenation of lookups of its fields, unrolled for speed. Fields are checked for type by kinds:
+	# tables accept equal values of other types (5.0 == 5, 1 == True); value of wrong type gives None
+	if len(lookups) == 2:
+		(lookup0, lookup1) = lookups
+		if kinds is None:
+			def encode(value):
+				(value0, value1) = value
+				return lookup0(value0) + lookup1(value1)
+		else:
+			(kind0, kind1) = kinds
+			def encode(value):
+				(value0, value1) = value
+				if isinstance(value0, kind0) and isinstance(value1, kind1):
+					return lookup0(value0) + lookup1(value1)
+				return None
+	elif len(lookups) == 3:
+		(lookup0, lookup1, lookup2) = lookups
+		if kinds is None:
+			def encode(value):
+				(value0, value1, value2) = value
+				return lookup0(value0) + lookup1(value1) + lookup2(value2)
+		else:
+			(kind0, kind1, kind2) = kinds
+			def encode(value):
+				(value0, value1, value2) = value
+				if isinstance(value0, kind0) and isinstance(value1, kind1) and isinstance(value2, kind2):
+					return lookup0(value0) + lookup1(value1) + lookup2(value2)
+				return None
+	else:
+		(lookup0, lookup1, lookup2, lookup3) = lookups
+		if kinds is None:
+			def encode(value):
+				(value0, value1, value2, value3) = value
+				return lookup0(value0) + lookup1(value1) + lookup2(value2) + lookup3(value3)
+		else:
+			(kind0, kind1, kind2, kind3) = kinds
+			def encode(value):
+				(value0, value1, value2, value3) = value
+				if isinstance(value0, kind0) and isinstance(value1, kind1) and isinstance(value2, kind2) and isinstance(value3, kind3):
+					return lookup0(value0) + lookup1(value1) + lookup2(value2) + lookup3(value3)
+				return None
+	return encode
+
+def _compileEncoder(command, record, fields):
+	# Per field dict of bytes of every valid value (int in range, Enum member or bool): lookup validates and encodes at once,
+	# missing value gives None, which fails concatenation
+	tables = []
+	for field in fields:
+		if field.values is None:
+			tables.append(dict((value, b'%0*d' % (field.width, value)) for value in range(field.minimum, field.maximum + 1)))
+		elif field.values is bool:
+			tables.append({True: b'y', False: b'n'})
+		else:
+			tables.append(dict((item, ('%s' % item.value).encode('UTF-8')) for item in field.values))
+	kinds = [int if field.values is None else field.values for field in fields]
+	if record is None:
+		(table, kind) = (tables[0], kinds[0])
+		if kind is int:
+			def encode(value):
+				return table.get(value) if isinstance(value, int) else None
+		else:
+			# Enum members are not equal to values of other types
+			encode = table.get
+		encodeUnchecked = table.__getitem__
+	else:
+		encode = _compileFields([table.get for table in tables], kinds)
+		encodeUnchecked = _compileFields([table.__getitem__ for table in tables])
+	prefixes = dict((direction, ('%s%s%s' % (COMMAND_CHAR, command.value, direction.value)).encode('UTF-8')) for direction in CommandDirection)
+	return (prefixes, encode, encodeUnchecked)
+
+# Encoders share COMMAND_SCHEMA with decoders
+_ENCODERS = dict((command, _compileEncoder(command, record, fields)) for (command, (record, fields)) in COMMAND_SCHEMA.items())
+_FRAME_PREFIX_LENGTH = len(_COMMAND_BYTE) + 2
+
+def _checkArgument(command, value):
+	'''Raise AssertionError, which describes invalid field of value'''
+	(record, fields) = COMMAND_SCHEMA[command]
+	values = (value,) if record is None else value
+	assert (hasattr(values, '__len__') and (len(values) == len(fields))), '%s must have %d fields: %r' % (command.name, len(fields), value)
+	for (field, value) in zip(fields, values):
+		if field.values is None:
+			assert (isinstance(value, int) and (field.minimum <= value <= field.maximum)), '%s must be int between %d and %d: %r' % (field.name, field.minimum, field.maximum, value)
+		else:
+			assert isinstance(value, field.values), '%s must be %s: %r' % (field.name, field.values.__name__, value)
+	assert False, '%s value is not valid: %r' % (command.name, value)
+
+def EncodeFrame(command, direction, value=None):
+	'''Encode frame (bytes) of command as transmitted: read-command without value, or with value as returned by DecodeResponse'''
+	encoder = _ENCODERS.get(command)
+	assert (encoder is not None), 'command must be Command: %r' % command
+	(prefixes, encode, encodeUnchecked) = encoder
+	prefix = prefixes.get(direction)
+	assert (prefix is not None), 'direction must be CommandDirection: %r' % direction
+	if (value is None) and (direction is CommandDirection.READ):
+		return prefix
+	try:
+		frame = prefix + encode(value)
+	except (TypeError, ValueError):
+		# Field is not valid, value is not a sequence or has wrong length
+		_checkArgument(command, value)
+	return frame
+
+def EncodeFrameUnchecked(command, direction, value):
+	'''EncodeFrame without validation for trusted callers: value must be valid, e.g. decoded or validated already'''
+	encoder = _ENCODERS[command]
+	return encoder[0][direction] + encoder[2](value)
+
+def EncodeArgument(command, value):
+	'''Encode value of command (as returned by DecodeResponse) to command argument'''
+	return EncodeFrame(command, CommandDirection.WRITE, value)[_FRAME_PREFIX_LENGTH:].decode('UTF-8')
+
+def FormatResponse(response):
+	'''Format Response record in human-readable form'''
+	out = "User pressed buttons. Now " if (response.direction == CommandDirection.USER) else "Response: "
+	out += "%s is " % response.command.name
+	value = response.value
+	if isinstance(value, Enum):
+		out += value.name
+	elif response.command == Command.BRIGHTNESS:
+		out += "%d/100" % value
+	elif response.command == Command.ZONE:
+		out += 'top: %s, bottom: %s, left: %s, right: %s' % tuple("on" if flag else "off" for flag in value)
+	elif response.command in (Command.AMBIENT_COLOR, Command.SATURATION):
+		out += 'red: %d/255, green: %d/255, blue: %d/255' % value
+	elif response.command == Command.CUSTOM_LED_COUNT:
+		out += 'vertical: %d LEDs (min 8, max 32), horizontal: %d LEDs (min 14, max 60), %s' % (value.vertical, value.horizontal, value.customLEDMode.name)
+	elif response.command == Command.MUSIC_MODE_COLOR:
+		out += 'treble: %s, middle: %s, bass: %s' % tuple(color.name for color in value)
+	elif response.command == Command.VIDEO_MINIMUM_INTENSITY:
+		out += 'red: %d/50, green: %d/50, blue: %d/50' % value
+	elif response.command == Command.FADE_RATE:
+		out += "%d (min 4, max 50)" % value
+	elif response.command == Command.VERSION_NUMBER:
+		out += '%d.%d' % value
+	elif response.command == Command.MUSIC_MODE_WEIGHTS:
+		out += 'treble: %d, middle: %d, bass: %d (min 5, max 25)' % value
+	return out
+
 class DreamScreenDefaultDelegate(btle.DefaultDelegate):
 	def __init__(self):
 		btle.DefaultDelegate.__init__(self)
 
 	def handleNotification(self, cHandle, data):
-		response = data.split()[0].decode('UTF-8')
-		DBG('%s %s' % (hex(cHandle), response), 'WHITE')
-		assert (len(response) > 3), 'response length must be greather than 3: %r (%d)' % (response, len(response))
-		assert (response[0] == COMMAND_CHAR), 'response must start with %s: %r' % (COMMAND_CHAR, response[0])
+		response = DecodeResponse(data)
+		if _log.isEnabledFor(logging.DEBUG):
+			_log.debug('%#x %r %s', cHandle, data, FormatResponse(response))
+		return response
 
-		try:
-			command = Command(response[1])
-		except ValueError as e:
-			assert False, 'command is not recognised: %r' % response[1]
+# Fields of Snapshot and their commands in order of writing: installation settings first, then
+# the ones which switch mode of DS, and the mode itself at last; None command - read-only field
+SNAPSHOT_FIELDS = (
+	('sku', Command.SKU),
+	('customLEDCount', Command.CUSTOM_LED_COUNT),
+	('brightness', Command.BRIGHTNESS),
+	('zone', Command.ZONE),
+	('saturation', Command.SATURATION),
+	('fadeRate', Command.FADE_RATE),
+	('videoMinimumIntensity', Command.VIDEO_MINIMUM_INTENSITY),
+	('musicModeWeights', Command.MUSIC_MODE_WEIGHTS),
+	('musicModeColor', Command.MUSIC_MODE_COLOR),
+	('ambientColor', Command.AMBIENT_COLOR),
+	('musicModeType', Command.MUSIC_MODE_TYPE),
+	('ambientShowType', Command.AMBIENT_SHOW_TYPE),
+	('mode', Command.MODE),
+	('versionNumber', None),
+)
+_SNAPSHOT_COMMANDS = [(name, command if command is not None else Command.VERSION_NUMBER) for (name, command) in SNAPSHOT_FIELDS]
+SNAPSHOT_FORMAT = 1
 
-		try:
-			commandDirection = CommandDirection(response[2])
-		except ValueError as e:
-			assert False, 'command direction is not recognised: %r' % response[2]
-		assert (commandDirection != CommandDirection.WRITE), 'command direction - write! Impossibru!'
+def _fieldToByte(field, value):
+	if field.values is None:
+		return value
+	if field.values is bool:
+		return 1 if value else 0
+	return value.value if isinstance(value.value, int) else ord(value.value)
 
-		argument = response[3:]
+_BYTE_LOOKUPS = dict((field, dict((_fieldToByte(field, item), item) for item in field.values)) for (record, fields) in COMMAND_SCHEMA.values() for field in fields if field.values not in (None, bool))
 
-		out = "User pressed buttons. Now " if (commandDirection == CommandDirection.USER) else "Response: "
-		out += "%s is " % command.name
-		if command == Command.MODE:
-			try:
-				out += "%s" % Mode(parse('{:d}', argument)[0]).name
-			except ValueError as e:
-				assert False, 'mode is not recognised: %r' % argument
-		elif command == Command.BRIGHTNESS:
-			brightness = parse('{:d}', argument)[0]
-			assert (isinstance(brightness, int) and (brightness >= 0) and (brightness <= 100)), 'brightness must be int between 0 and 100: %r' % brightness
-			out += "%d/100" % brightness
-		elif command == Command.ZONE:
-			top = (argument[0] == 'y')
-			bottom = (argument[1] == 'y')
-			left = (argument[2] == 'y')
-			right = (argument[3] == 'y')
-			out += 'top: %s, bottom: %s, left: %s, right: %s' % ("on" if top else "off", "on" if bottom else "off", "on" if left else "off", "on" if right else "off")
-		elif command == Command.AMBIENT_COLOR:
-			red = parse('{:d}', argument[0:3])[0]
-			green = parse('{:d}', argument[3:6])[0]
-			blue = parse('{:d}', argument[6:])[0]
-			assert (isinstance(red, int) and (red >= 0) and (red <= 255)), 'red must be int between 0 and 255: %r' % red
-			assert (isinstance(green, int) and (green >= 0) and (green <= 255)), 'green must be int between 0 and 255: %r' % green
-			assert (isinstance(blue, int) and (blue >= 0) and (blue <= 255)), 'blue must be int between 0 and 255: %r' % blue
-			out += 'red: %d/255, green: %d/255, blue: %d/255' % (red, green, blue)
-		elif command == Command.SATURATION:
-			red = parse('{:d}', argument[0:3])[0]
-			green = parse('{:d}', argument[3:6])[0]
-			blue = parse('{:d}', argument[6:])[0]
-			assert (isinstance(red, int) and (red >= 0) and (red <= 255)), 'red must be int between 0 and 255: %r' % red
-			assert (isinstance(green, int) and (green >= 0) and (green <= 255)), 'green must be int between 0 and 255: %r' % green
-			assert (isinstance(blue, int) and (blue >= 0) and (blue <= 255)), 'blue must be int between 0 and 255: %r' % blue
-			out += 'red: %d/255, green: %d/255, blue: %d/255' % (red, green, blue)
-		if command == Command.SKU:
-			try:
-				out += "%s" % SKU(parse('{:d}', argument)[0]).name
-			except ValueError as e:
-				assert False, 'SKU is not recognised: %r' % argument
-		elif command == Command.CUSTOM_LED_COUNT:
-			vertical = parse('{:d}', argument[0:3])[0]
-			horizontal = parse('{:d}', argument[3:6])[0]
-			try:
-				customLEDMode = CustomLEDMode(argument[6])
-			except ValueError as e:
-				assert False, 'customLEDMode is not recognised: %r' % argument
-			assert (isinstance(vertical, int) and (vertical >= 8) and (vertical <= 32)), 'vertical must be int between 8 and 32: %r' % vertical
-			assert (isinstance(horizontal, int) and (horizontal >= 14) and (horizontal <= 60)), 'horizontal must be int between 14 and 60: %r' % horizontal
-			out += 'vertical: %d LEDs (min 8, max 32), horizontal: %d LEDs (min 14, max 60), %s' % (vertical, horizontal, customLEDMode.name)
-		if command == Command.MUSIC_MODE_TYPE:
-			try:
-				out += "%s" % MusicModeType(parse('{:d}', argument)[0]).name
-			except ValueError as e:
-				assert False, 'MusicModeType is not recognised: %r' % argument
-		if command == Command.MUSIC_MODE_COLOR:
-			try:
-				out += 'treble: %s, ' % MusicModeColor(parse('{:d}', argument[0])[0]).name
-			except ValueError as e:
-				assert False, 'MusicModeColor is not recognised: %r' % argument[0]
-			try:
-				out += 'middle: %s, ' % MusicModeColor(parse('{:d}', argument[1])[0]).name
-			except ValueError as e:
-				assert False, 'MusicModeColor is not recognised: %r' % argument[1]
-			try:
-				out += 'bass: %s' % MusicModeColor(parse('{:d}', argument[2])[0]).name
-			except ValueError as e:
-				assert False, 'MusicModeColor is not recognised: %r' % argument[2]
-		elif command == Command.VIDEO_MINIMUM_INTENSITY:
-			red = parse('{:d}', argument[0:3])[0]
-			green = parse('{:d}', argument[3:6])[0]
-			blue = parse('{:d}', argument[6:])[0]
-			assert (isinstance(red, int) and (red >= 0) and (red <= 50)), 'red must be int between 0 and 50: %r' % red
-			assert (isinstance(green, int) and (green >= 0) and (green <= 50)), 'green must be int between 0 and 50: %r' % green
-			assert (isinstance(blue, int) and (blue >= 0) and (blue <= 50)), 'blue must be int between 0 and 50: %r' % blue
-			out += 'red: %d/50, green: %d/50, blue: %d/50' % (red, green, blue)
-		if command == Command.AMBIENT_SHOW_TYPE:
+def _byteToField(field, byte):
+	if field.values is None:
+		assert (field.minimum <= byte <= field.maximum), '%s must be int between %d and %d: %r' % (field.name, field.minimum, field.maximum, byte)
+		return byte
+	if field.values is bool:
+		return byte != 0
+	item = _BYTE_LOOKUPS[field].get(byte)
+	assert (item is not None), '%s is not recognised: %r' % (field.name, byte)
+	return item
+
+class Snapshot(object):
+	'''All settings of DS; values as returned by Get* methods, None if unknown
+
+	Packed to fixed layout: format version, bitmask of known fields and one byte per field of COMMAND_SCHEMA.
+	'''
+	__slots__ = tuple(name for (name, command) in SNAPSHOT_FIELDS)
+	_struct = struct.Struct('<BH%dB' % sum(len(COMMAND_SCHEMA[command][1]) for (name, command) in _SNAPSHOT_COMMANDS))
+	size = _struct.size
+
+	def __init__(self, **values):
+		for name in self.__slots__:
+			setattr(self, name, values.pop(name, None))
+		assert (not values), 'unknown Snapshot fields: %r' % list(values)
+
+	def __eq__(self, other):
+		return isinstance(other, Snapshot) and all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		return 'Snapshot(%s)' % ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.__slots__ if getattr(self, name) is not None)
+
+	def Writes(self):
+		'''Return list of (command, value) of known writable fields, in order of writing'''
+		return [(command, getattr(self, name)) for (name, command) in SNAPSHOT_FIELDS if (command is not None) and (getattr(self, name) is not None)]
+
+	def Pack(self):
+		known = 0
+		data = []
+		for (index, (name, command)) in enumerate(_SNAPSHOT_COMMANDS):
+			(record, fields) = COMMAND_SCHEMA[command]
+			value = getattr(self, name)
+			if value is None:
+				data.extend([0] * len(fields))
+				continue
+			known |= 1 << index
+			data.extend(_fieldToByte(field, item) for (field, item) in zip(fields, (value,) if record is None else value))
+		return self._struct.pack(SNAPSHOT_FORMAT, known, *data)
+
+	@classmethod
+	def Unpack(cls, data, offset=0):
+		unpacked = cls._struct.unpack_from(data, offset)
+		assert (unpacked[0] == SNAPSHOT_FORMAT), 'snapshot format is not supported: %r' % unpacked[0]
+		known = unpacked[1]
+		position = 2
+		snapshot = cls()
+		for (index, (name, command)) in enumerate(_SNAPSHOT_COMMANDS):
+			(record, fields) = COMMAND_SCHEMA[command]
+			if known & (1 << index):
+				values = [_byteToField(field, byte) for (field, byte) in zip(fields, unpacked[position:position + len(fields)])]
+				setattr(snapshot, name, values[0] if record is None else record(*values))
+			position += len(fields)
+		return snapshot
+
+	@classmethod
+	def UnpackAll(cls, data):
+		'''Unpack concatenation of packed snapshots'''
+		return [cls.Unpack(data, offset) for offset in range(0, len(data), cls.size)]
+
+# Writes, which change other settings of DS too
+_WRITE_SIDE_EFFECTS = {
+	Command.AMBIENT_COLOR: (Command.MODE, Mode.AMBIENT_STATIC),
+	Command.MUSIC_MODE_TYPE: (Command.MODE, Mode.MUSIC),
+	Command.AMBIENT_SHOW_TYPE: (Command.MODE, Mode.AMBIENT_SHOW),
+}
+
+class StateCache(object):
+	'''Last known values of DS settings by Command, each valid for TTL seconds (None - forever)'''
+	def __init__(self, ttl=CACHE_TTL):
+		self.ttl = ttl
+		# TTL overrides by Command
+		self.ttls = {}
+		self._values = {}
+
+	def Get(self, command):
+		'''Return cached value of command or None, if it is unknown or expired'''
+		entry = self._values.get(command)
+		if entry is None:
+			return None
+		(value, expires) = entry
+		if (expires is not None) and (expires <= time.time()):
+			# Other thread may expire it at the same time
+			self._values.pop(command, None)
+			return None
+		return value
+
+	def Set(self, command, value):
+		ttl = self.ttls.get(command, self.ttl)
+		self._values[command] = (value, None if ttl is None else time.time() + ttl)
+
+	def Invalidate(self, command=None):
+		if command is None:
+			self._values.clear()
+		else:
+			self._values.pop(command, None)
+
+	def InEffect(self, command, value, sideEffects=True):
+		'''Return True if writing value of command would not change DS state (ignoring mode switching, if not sideEffects)'''
+		if (value is None) or (self.Get(command) != value):
+			return False
+		if sideEffects and (command in _WRITE_SIDE_EFFECTS):
+			(sideCommand, sideValue) = _WRITE_SIDE_EFFECTS[command]
+			return self.Get(sideCommand) == sideValue
+		return True
+
+	def Written(self, command, value):
+		'''Update cache after successful write of value'''
+		self.Set(command, value)
+		if (command == Command.MODE) and (value == Mode.IDENTIFY):
+			# DS returns to the previous mode in a few seconds
+			self.Invalidate(Command.MODE)
+		elif command in _WRITE_SIDE_EFFECTS:
+			self.Set(*_WRITE_SIDE_EFFECTS[command])
+
+class RTTEstimator(object):
+	'''Estimator of round trip time to DS and of read timeout from it, as in TCP (RFC 6298)'''
+	ALPHA = 0.125
+	BETA = 0.25
+	K = 4
+
+	def __init__(self, initial=READ_TIMEOUT, minimum=MIN_READ_TIMEOUT, maximum=MAX_READ_TIMEOUT):
+		self.minimum = minimum
+		self.maximum = maximum
+		self.srtt = None
+		self.rttvar = None
+		self.timeout = initial
+
+	def Sample(self, rtt):
+		'''Update estimation by measured round trip time'''
+		if self.srtt is None:
+			self.srtt = rtt
+			self.rttvar = rtt / 2.0
+		else:
+			self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+			self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+		self.timeout = min(self.maximum, max(self.minimum, self.srtt + self.K * self.rttvar))
+
+	def Backoff(self):
+		'''Double timeout after the response is lost'''
+		self.timeout = min(self.maximum, self.timeout * 2)
+
+class Histogram(object):
+	'''Counts of samples in fixed buckets by upper bound, the last bucket is unbounded'''
+	__slots__ = ('bounds', 'counts', 'count', 'sum')
+
+	def __init__(self, bounds=LATENCY_BUCKETS):
+		self.bounds = tuple(bounds)
+		self.counts = [0] * (len(self.bounds) + 1)
+		self.count = 0
+		self.sum = 0.0
+
+	def Observe(self, value):
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.count += 1
+		self.sum += value
+
+	def Cumulative(self):
+		'''Return list of (upper bound, number of samples not greater than it), the last bound is float('inf')'''
+		result = []
+		total = 0
+		for (bound, count) in zip(self.bounds + (float('inf'),), self.counts):
+			total += count
+			result.append((bound, total))
+		return result
+
+	def Quantile(self, q):
+		'''Return upper bound of bucket of q-quantile (0..1), or None without samples'''
+		if not self.count:
+			return None
+		rank = q * self.count
+		for (bound, total) in self.Cumulative():
+			if total >= rank:
+				return bound
+
+class CommandMetrics(object):
+	'''Counters of one Command of DS'''
+	__slots__ = ('writes', 'reads', 'responses', 'notifications', 'timeouts', 'decodeFailures', 'bytesSent', 'bytesReceived', 'latency')
+
+	def __init__(self, buckets=LATENCY_BUCKETS):
+		self.writes = 0
+		self.reads = 0
+		self.responses = 0
+		self.notifications = 0
+		self.timeouts = 0
+		self.decodeFailures = 0
+		self.bytesSent = 0
+		self.bytesReceived = 0
+		# Round trips of read-commands, seconds
+		self.latency = Histogram(buckets)
+
+class Metrics(object):
+	'''Counters and response latency histograms of DS by Command'''
+	def __init__(self, address=None, buckets=LATENCY_BUCKETS):
+		self.address = address
+		self.buckets = buckets
+		self.Reset()
+
+	def Reset(self):
+		self.commands = dict((command, CommandMetrics(self.buckets)) for command in Command)
+		# Notifications, which command is not recognised
+		self.decodeFailures = 0
+		self.bytesReceived = 0
+
+	def Transmitted(self, command, direction, size):
+		metrics = self.commands[command]
+		if direction == CommandDirection.WRITE:
+			metrics.writes += 1
+		else:
+			metrics.reads += 1
+		metrics.bytesSent += size
+
+	def Received(self, response, size):
+		metrics = self.commands[response.command]
+		if response.direction == CommandDirection.USER:
+			metrics.notifications += 1
+		metrics.bytesReceived += size
+
+	def Answered(self, command, latency):
+		metrics = self.commands[command]
+		metrics.responses += 1
+		metrics.latency.Observe(latency)
+
+	def TimedOut(self, command):
+		self.commands[command].timeouts += 1
+
+	def DecodeFailed(self, data):
+		decoder = _DECODERS.get(data[1:2])
+		if decoder is None:
+			self.decodeFailures += 1
+			self.bytesReceived += len(data)
+		else:
+			self.commands[decoder[0]].decodeFailures += 1
+			self.commands[decoder[0]].bytesReceived += len(data)
+
+	def ToDict(self):
+		'''Return metrics as dict for JSON'''
+		commands = OrderedDict()
+		for command in Command:
+			metrics = self.commands[command]
+			values = OrderedDict((name, getattr(metrics, name)) for name in CommandMetrics.__slots__ if name != 'latency')
+			values['latency'] = OrderedDict([
+				('buckets', [[None if bound == float('inf') else bound, total] for (bound, total) in metrics.latency.Cumulative()]),
+				('count', metrics.latency.count),
+				('sum', metrics.latency.sum),
+			])
+			commands[command.name] = values
+		return OrderedDict([('address', self.address), ('decodeFailures', self.decodeFailures), ('bytesReceived', self.bytesReceived), ('commands', commands)])
+
+# Prometheus counters: name, help, series of (CommandMetrics attribute, extra label)
+_PROMETHEUS_COUNTERS = (
+	('dsbtle_commands_total', 'Commands transmitted to DS', (('writes', 'direction="write"'), ('reads', 'direction="read"'))),
+	('dsbtle_responses_total', 'Responses to read-commands', (('responses', ''),)),
+	('dsbtle_notifications_total', 'User notifications (changes by DS buttons)', (('notifications', ''),)),
+	('dsbtle_timeouts_total', 'Read-commands without response', (('timeouts', ''),)),
+	('dsbtle_decode_failures_total', 'Notifications, which could not be decoded', (('decodeFailures', ''),)),
+	('dsbtle_bytes_total', 'Bytes on air', (('bytesSent', 'direction="sent"'), ('bytesReceived', 'direction="received"'))),
+)
+
+def _prometheusLabels(*labels):
+	return '{%s}' % ','.join(label for label in labels if label)
+
+def FormatPrometheus(metrics):
+	'''Return Prometheus text exposition of Metrics of one or many DS'''
+	if isinstance(metrics, Metrics):
+		metrics = [metrics]
+	lines = []
+	for (name, description, series) in _PROMETHEUS_COUNTERS:
+		lines.append('# HELP %s %s' % (name, description))
+		lines.append('# TYPE %s counter' % name)
+		for device in metrics:
+			address = 'address="%s"' % (device.address or '')
+			for command in Command:
+				for (attribute, label) in series:
+					lines.append('%s%s %d' % (name, _prometheusLabels(address, 'command="%s"' % command.name, label), getattr(device.commands[command], attribute)))
+			if name == 'dsbtle_decode_failures_total':
+				lines.append('%s%s %d' % (name, _prometheusLabels(address, 'command=""'), device.decodeFailures))
+			elif name == 'dsbtle_bytes_total':
+				lines.append('%s%s %d' % (name, _prometheusLabels(address, 'command=""', 'direction="received"'), device.bytesReceived))
+	name = 'dsbtle_response_latency_seconds'
+	lines.append('# HELP %s Round trip of read-commands' % name)
+	lines.append('# TYPE %s histogram' % name)
+	for device in metrics:
+		address = 'address="%s"' % (device.address or '')
+		for command in Command:
+			histogram = device.commands[command].latency
+			labels = (address, 'command="%s"' % command.name)
+			for (bound, total) in histogram.Cumulative():
+				lines.append('%s_bucket%s %d' % (name, _prometheusLabels(*labels + ('le="%s"' % ('+Inf' if bound == float('inf') else repr(bound)),)), total))
+			lines.append('%s_sum%s %r' % (name, _prometheusLabels(*labels), histogram.sum))
+			lines.append('%s_count%s %d' % (name, _prometheusLabels(*labels), histogram.count))
+	return '\n'.join(lines) + '\n'
+
+def FormatJSON(metrics, indent=None):
+	'''Return JSON of Metrics of one or many DS'''
+	if isinstance(metrics, Metrics):
+		metrics = [metrics]
+	return json.dumps([device.ToDict() for device in metrics], indent=indent)
+
+class PendingCommand(object):
+	'''Read command transmitted to DS and waiting for its response'''
+	__slots__ = ('command', 'sent', 'deadline', 'response', 'done', 'callback')
+
+	def __init__(self, command, deadline, callback=None):
+		self.command = command
+		self.sent = time.time()
+		self.deadline = deadline
+		self.response = None
+		self.done = False
+		# Called with the request when it is answered or expired
+		self.callback = callback
+
+	def _complete(self, response):
+		self.response = response
+		self.done = True
+		if self.callback is not None:
+			self.callback(self)
+
+	def TimedOut(self):
+		return self.done and (self.response is None)
+
+# Decoded notification of DS at address (MAC), received at time
+Event = namedtuple('Event', 'address response time')
+
+class Subscription(object):
+	'''Bounded queue of events, which match filters of subscriber (None - any)
+
+	When the queue is full, the oldest event (or the new one, if not dropOldest) is dropped and counted,
+	so slow subscriber never stalls reading of notifications.
+	'''
+	def __init__(self, bus, commands=None, directions=None, addresses=None, maxsize=EVENT_QUEUE_SIZE, dropOldest=True):
+		assert isinstance(maxsize, int) and (maxsize > 0), 'maxsize must be positive int: %r' % maxsize
+		self.bus = bus
+		self.commands = None if commands is None else frozenset(commands)
+		self.directions = None if directions is None else frozenset(directions)
+		self.addresses = None if addresses is None else frozenset(addresses)
+		self.maxsize = maxsize
+		self.dropOldest = dropOldest
+		# Events accepted and dropped on overflow
+		self.received = 0
+		self.dropped = 0
+		self.closed = False
+		# Called without arguments after each queued event, from the thread reading notifications
+		self.callback = None
+		self._events = deque()
+		self._condition = threading.Condition()
+
+	def __len__(self):
+		return len(self._events)
+
+	def __iter__(self):
+		'''Iterate over events, blocking until the subscription is closed'''
+		while True:
+			event = self.Get()
+			if event is None:
+				return
+			yield event
+
+	def Matches(self, event):
+		return (((self.commands is None) or (event.response.command in self.commands))
+			and ((self.directions is None) or (event.response.direction in self.directions))
+			and ((self.addresses is None) or (event.address in self.addresses)))
+
+	def _put(self, event):
+		with self._condition:
+			if len(self._events) >= self.maxsize:
+				self.dropped += 1
+				if not self.dropOldest:
+					return
+				self._events.popleft()
+			self._events.append(event)
+			self.received += 1
+			self._condition.notify()
+		if self.callback is not None:
+			self.callback()
+
+	def Get(self, timeout=None):
+		'''Return the next event, or None on timeout (None - wait forever) or if closed'''
+		deadline = None if timeout is None else time.time() + timeout
+		with self._condition:
+			while (not self._events) and (not self.closed):
+				remaining = None if deadline is None else deadline - time.time()
+				if (remaining is not None) and (remaining <= 0):
+					return None
+				self._condition.wait(remaining)
+			return self._events.popleft() if self._events else None
+
+	def GetAll(self):
+		'''Return list of all queued events without waiting'''
+		with self._condition:
+			events = list(self._events)
+			self._events.clear()
+			return events
+
+	def Close(self):
+		self.bus.Unsubscribe(self)
+		with self._condition:
+			self.closed = True
+			self._condition.notify_all()
+		if self.callback is not None:
+			self.callback()
+
+class EventBus(object):
+	'''Fan-out of notifications of one or many DS to subscribers'''
+	def __init__(self):
+		self.published = 0
+		# Replaced, not modified, so publishing needs no lock
+		self._subscriptions = ()
+		self._lock = threading.Lock()
+
+	def Subscribe(self, commands=None, directions=None, addresses=None, maxsize=EVENT_QUEUE_SIZE, dropOldest=True):
+		'''Return new Subscription to events of given Commands, CommandDirections and DS addresses (None - any)'''
+		_log.debug('EventBus.Subscribe')
+		subscription = Subscription(self, commands, directions, addresses, maxsize, dropOldest)
+		with self._lock:
+			self._subscriptions += (subscription,)
+		return subscription
+
+	def Unsubscribe(self, subscription):
+		with self._lock:
+			self._subscriptions = tuple(s for s in self._subscriptions if s is not subscription)
+
+	def Publish(self, event):
+		self.published += 1
+		for subscription in self._subscriptions:
+			if subscription.Matches(event):
+				subscription._put(event)
+
+	@property
+	def dropped(self):
+		'''Events dropped by all current subscribers'''
+		return sum(subscription.dropped for subscription in self._subscriptions)
+
+# Characteristics of DS service: attribute of DreamScreen, UUID
+_DS_CHARACTERISTICS = (
+	('ds_command_char', DS_COMMAND_UUID),
+	('ds_response_char', DS_RESPONSE_UUID),
+	('ds_name_char', DS_NAME_UUID),
+)
+
+class HandleCache(object):
+	'''Persistent GATT handles of DS service by MAC, with firmware version of DS they were discovered on
+
+	Entry is dict: firmware ([major, minor] or None), service ([start, end]), characteristics ({attribute: [handle, properties, valHandle]}), cccd.
+	'''
+	def __init__(self, path=HANDLE_CACHE_PATH):
+		self.path = path
+		self._entries = None
+		self._lock = threading.Lock()
+
+	def _load(self):
+		if self._entries is None:
 			try:
-				out += "%s" % AmbientShowType(parse('{:d}', argument)[0]).name
-			except ValueError as e:
-				assert False, 'AmbientShowType is not recognised: %r' % argument
-		elif command == Command.FADE_RATE:
-			fateRate = parse('{:d}', argument)[0]
-			assert (isinstance(fateRate, int) and (fateRate >= 4) and (fateRate <= 50)), 'fateRate must be int between 4 and 50: %r' % fateRate
-			out += "%d (min 4, max 50)" % fateRate
-		elif command == Command.VERSION_NUMBER:
-			major = parse('{:d}', argument[0:2])[0]
-			minor = parse('{:d}', argument[2:4])[0]
-			assert (isinstance(major, int) and (major >= 0) and (major <= 99)), 'major must be int between 0 and 99: %r' % major
-			assert (isinstance(minor, int) and (minor >= 0) and (minor <= 99)), 'minor must be int between 0 and 99: %r' % minor
-			out += '%d.%d' % (major, minor)
-		elif command == Command.MUSIC_MODE_WEIGHTS:
-			treble = parse('{:d}', argument[0:3])[0]
-			middle = parse('{:d}', argument[3:6])[0]
-			bass = parse('{:d}', argument[6:])[0]
-			assert (isinstance(treble, int) and (treble >= 5) and (treble <= 25)), 'treble must be int between 5 and 25: %r' % treble
-			assert (isinstance(middle, int) and (middle >= 5) and (middle <= 25)), 'middle must be int between 5 and 25: %r' % middle
-			assert (isinstance(bass, int) and (bass >= 5) and (bass <= 25)), 'bass must be int between 5 and 25: %r' % bass
-			out += 'treble: %d, middle: %d, bass: %d (min 5, max 25)' % (treble, middle, bass)
-			
-		print(out)
+				with open(self.path) as f:
+					self._entries = json.load(f)
+			except (IOError, OSError, ValueError) as e:
+				_log.debug('HandleCache: %s', e)
+				self._entries = {}
+		return self._entries
+
+	def _save(self):
+		directory = os.path.dirname(self.path)
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+		temporary = '%s.%d' % (self.path, os.getpid())
+		with open(temporary, 'w') as f:
+			json.dump(self._entries, f, indent=1, sort_keys=True)
+		# Atomic on POSIX, readers never see partial file
+		os.rename(temporary, self.path)
+
+	def Get(self, address):
+		with self._lock:
+			return self._load().get(address.lower())
+
+	def Set(self, address, entry):
+		with self._lock:
+			self._load()[address.lower()] = entry
+			self._save()
+
+	def Invalidate(self, address):
+		with self._lock:
+			if self._load().pop(address.lower(), None) is not None:
+				self._save()
+
+def _isDisconnect(e):
+	'''True if exception means dropped link: BTLEDisconnectError, or BTLEException with DISCONNECTED code of old bluepy'''
+	disconnectError = getattr(btle, 'BTLEDisconnectError', None)
+	if (disconnectError is not None) and isinstance(e, disconnectError):
+		return True
+	code = getattr(btle.BTLEException, 'DISCONNECTED', None)
+	return (code is not None) and (getattr(e, 'code', None) == code)
+
+def _helperFileno(connection):
+	'''File descriptor of bluepy-helper output of connection, or None'''
+	helper = getattr(connection, '_helper', None)
+	if helper is None:
+		return None
+	return helper.stdout.fileno()
+
+class _NotificationDispatcher(btle.DefaultDelegate):
+	'''Pass notifications to the user delegate and match responses to pending commands'''
+	def __init__(self, dreamScreen, delegate):
+		btle.DefaultDelegate.__init__(self)
+		self.dreamScreen = dreamScreen
+		self.delegate = delegate
+
+	def handleNotification(self, cHandle, data):
+		ring = self.dreamScreen._ring
+		if ring is not None:
+			# Reader thread dispatches it after releasing the connection
+			if len(ring) == ring.maxlen:
+				self.dreamScreen.readerOverflows += 1
+			ring.append((cHandle, data))
+			return None
+		return self.Dispatch(cHandle, data)
+
+	def Dispatch(self, cHandle, data):
+		try:
+			response = self.delegate.handleNotification(cHandle, data)
+			if not isinstance(response, Response):
+				response = DecodeResponse(data)
+		except (AssertionError, IndexError, UnicodeDecodeError) as e:
+			self.dreamScreen.log.debug('Dispatch: %s %r', e, data)
+			self.dreamScreen.metrics.DecodeFailed(data)
+			return None
+		self.dreamScreen.metrics.Received(response, len(data))
+		self.dreamScreen._handleResponse(response)
+		self.dreamScreen.events.Publish(Event(self.dreamScreen.address, response, time.time()))
+		return response
 
 class DreamScreen:
-	def __init__(self, connection, peripheralDelegate):
+	def __init__(self, connection, peripheralDelegate, events=None, handles=None):
 		assert isinstance(connection, btle.Peripheral), 'connection must be btle.Peripheral'
 		assert isinstance(peripheralDelegate, btle.DefaultDelegate), 'peripheralDelegate must be btle.DefaultDelegate'
-		DBG('__init__')
+		assert (events is None) or isinstance(events, EventBus), 'events must be EventBus: %r' % events
+		assert (handles is None) or isinstance(handles, HandleCache), 'handles must be HandleCache: %r' % handles
 		self.connection = connection
-		self.connection.setDelegate(peripheralDelegate)
+		self.address = getattr(connection, 'addr', None)
+		self.log = logging.getLogger('dsbtle.device.%s' % (self.address or 'unknown'))
+		self.log.debug('__init__')
+		self._addrType = getattr(connection, 'addrType', None) or btle.ADDR_TYPE_PUBLIC
+		self._iface = getattr(connection, 'iface', None)
+		self.delegate = peripheralDelegate
+		self.metrics = Metrics(self.address)
+		# Decoded notifications are published here, bus may be shared by many DS
+		self.events = events if events is not None else EventBus()
+		self._dispatcher = _NotificationDispatcher(self, peripheralDelegate)
+		self.connection.setDelegate(self._dispatcher)
+		# Read commands in flight, per Command in order of transmission
+		self._pending = dict((command, deque()) for command in Command)
+		self._pendingLock = threading.Lock()
+		# Optional reader thread: raw notifications are buffered in ring and dispatched without holding connection
+		self._reader = None
+		self._readerStop = threading.Event()
+		self._ring = None
+		# Poll of reader thread, which is started again after reconnect, if the drop stopped it; None - not started
+		self._readerPoll = None
+		self._dispatched = 0
+		self._notified = threading.Condition()
+		self.readerOverflows = 0
+		# Serialises access to connection, bluepy is not thread-safe
+		self._lock = threading.RLock()
+		# Coalesced writes: latest argument per Command, in order of first queuing
+		self._queuedWrites = OrderedDict()
+		self._queuedWritesCondition = threading.Condition()
+		self._flushThread = None
+		self._flushInterval = WRITE_TIMEOUT
+		self.coalescedWrites = 0
+		self.skippedWrites = 0
+		# Default delivery of Set* methods; fire-and-forget writes to verify: value by Command
+		self.delivery = Delivery.ACKED
+		self._unverified = OrderedDict()
+		self._unverifiedLock = threading.Lock()
+		self._verifyThread = None
+		self._verifyStop = threading.Event()
+		self.unconfirmedWrites = 0
+		self.lostWrites = 0
+		self.cache = StateCache()
+		self.rtt = RTTEstimator()
+		# DS needs a pause after write-command, it is kept before the next command
+		self._quietUntil = 0.0
+		# Automatic reconnect: (attempts, delay, maxDelay) or None
+		self._reconnect = None
+		self._reconnecting = False
+		self.reconnects = 0
+		# Read-command being transmitted by SubmitCommand, under the connection lock
+		self._submitting = None
+		# Threads, which must not block in Reconnect (event loop of AsyncDreamScreen): dropped link raises there
+		self._deferReconnect = threading.local()
+		# Last written value of every setting, re-applied after reconnect, in order of SNAPSHOT_FIELDS
+		self._desired = {}
+		# Persistent GATT handles, discovery is skipped if they are known
+		self.handles = handles
+		self._handlesEntry = None
+		# Firmware version read of _rememberHandles, nobody waits for it after reconnect
+		self._handlesProbe = None
+		# Client characteristic configuration of response characteristic
+		self._notificationsHandle = None
 
-		self.ds_service = connection.getServiceByUUID('0000ff60-0000-1000-8000-00805f9b34fb')
-		self.ds_command_char = self.ds_service.getCharacteristics('0000ff61-0000-1000-8000-00805f9b34fb')[0]
-		self.ds_response_char = self.ds_service.getCharacteristics('0000ff62-0000-1000-8000-00805f9b34fb')[0]
-		self.ds_name_char = self.ds_service.getCharacteristics('0000ff63-0000-1000-8000-00805f9b34fb')[0]
+		self._setup()
+		probe = self._rememberHandles()
+		if probe is not None:
+			self.WaitForResponses([probe])
+
+	def _setup(self):
+		'''Find DS characteristics and enable notifications'''
+		self.connection.setDelegate(self._dispatcher)
+		if (self.handles is not None) and (self.address is not None):
+			self._handlesEntry = self.handles.Get(self.address)
+			if (self._handlesEntry is not None) and self._setupCached(self._handlesEntry):
+				return
+			self._handlesEntry = None
+		self._discover()
+
+	def _discover(self):
+		self._notificationsHandle = None
+		self.ds_service = self.connection.getServiceByUUID(DS_SERVICE_UUID)
+		self.ds_command_char = self.ds_service.getCharacteristics(DS_COMMAND_UUID)[0]
+		self.ds_response_char = self.ds_service.getCharacteristics(DS_RESPONSE_UUID)[0]
+		self.ds_name_char = self.ds_service.getCharacteristics(DS_NAME_UUID)[0]
 
 		self.EnableNotifications(self.connection, self.ds_response_char)
 
+	def _setupCached(self, entry):
+		'''Use cached handles without discovery; return False if they do not work'''
+		self.log.debug('_setupCached(%s)', self.address)
+		try:
+			self.ds_service = btle.Service(self.connection, DS_SERVICE_UUID, *entry['service'])
+			for (attribute, uuid) in _DS_CHARACTERISTICS:
+				(handle, properties, valHandle) = entry['characteristics'][attribute]
+				setattr(self, attribute, btle.Characteristic(self.connection, uuid, handle, properties, valHandle))
+			# One GATT read checks the handles
+			self.connection.readCharacteristic(self.ds_name_char.getHandle())
+			# Handle of other attribute must not be written
+			descriptors = self.connection.getDescriptors(entry['cccd'], entry['cccd'])
+			if not any(d.uuid == btle.AssignedNumbers.client_characteristic_configuration for d in descriptors):
+				raise ValueError('0x%04x is not client characteristic configuration' % entry['cccd'])
+			self.connection.writeCharacteristic(entry['cccd'], b'\1\0')
+			self._notificationsHandle = entry['cccd']
+			return True
+		except (KeyError, TypeError, ValueError) as e:
+			self.log.debug('_setupCached: malformed entry: %s', e)
+		except btle.BTLEException as e:
+			if _isDisconnect(e):
+				raise
+			self.log.debug('_setupCached: %s', e)
+		self.handles.Invalidate(self.address)
+		return False
+
+	def _rememberHandles(self):
+		'''Submit read of firmware version without waiting, discovered handles are stored with it by _checkFirmware on response
+
+		Return the request or None. It may run on the reader thread or under the connection lock, where the response can not be waited for.
+		'''
+		if (self.handles is None) or (self.address is None) or (self._handlesEntry is not None):
+			return None
+		if self._notificationsHandle is None:
+			return None
+		self._handlesEntry = {
+			'firmware': None,
+			'service': [self.ds_service.hndStart, self.ds_service.hndEnd],
+			'characteristics': dict((attribute, [getattr(self, attribute).handle, getattr(self, attribute).properties, getattr(self, attribute).valHandle])
+				for (attribute, uuid) in _DS_CHARACTERISTICS),
+			'cccd': self._notificationsHandle,
+		}
+		self._handlesProbe = self.SubmitCommand(Command.VERSION_NUMBER, None, self._probed)
+		return self._handlesProbe
+
+	def _probed(self, request):
+		if request is not self._handlesProbe:
+			# Superseded after reconnect
+			return
+		self._handlesProbe = None
+		if request.TimedOut():
+			# Try again after the next reconnect
+			self._handlesEntry = None
+
+	def _expireProbe(self):
+		'''Expire overdue read of _rememberHandles, so it does not take response of a later read'''
+		probe = self._handlesProbe
+		if (probe is None) or (probe.deadline > time.time()):
+			return
+		# Response may have arrived meanwhile, nobody read it
+		self._drainNotifications()
+		self._expire(probe)
+
+	def _checkFirmware(self, version):
+		'''Store handles with firmware version; forget them, if firmware was updated since discovery'''
+		entry = self._handlesEntry
+		if (entry is None) or (entry['firmware'] == list(version)):
+			return
+		if entry['firmware'] is None:
+			entry['firmware'] = list(version)
+			self.handles.Set(self.address, entry)
+		else:
+			self.log.debug('_checkFirmware: %s updated to %s', self.address, version)
+			self._handlesEntry = None
+			self.handles.Invalidate(self.address)
+
 	def __del__(self):
 		pass
 
 	def EnableNotifications(self, connection, characteristic):
-		DBG('EnableNotifications')
+		self.log.debug('EnableNotifications')
 		assert isinstance(connection, btle.Peripheral), 'connection must be btle.Peripheral'
 		assert isinstance(characteristic, btle.Characteristic), 'characteristic must be btle.Characteristic'
 		for d in connection.getDescriptors(characteristic.getHandle(), characteristic.getHandle() + 1):
 			if (d.uuid == btle.AssignedNumbers.client_characteristic_configuration):
 				connection.writeCharacteristic(d.handle, b'\1\0')
+				if characteristic is self.ds_response_char:
+					self._notificationsHandle = d.handle
 				return True
 		return False
 
 	def WaitForNotifications(self, timeout=READ_TIMEOUT):
-		return self.connection.waitForNotifications(timeout)
+		if timeout <= 0:
+			# btle.Peripheral.waitForNotifications blocks forever on zero timeout
+			return False
+		if self._reader is not None:
+			with self._notified:
+				dispatched = self._dispatched
+				self._notified.wait(timeout)
+				return self._dispatched != dispatched
+		with self._lock:
+			return self._communicate(self.connection.waitForNotifications, timeout)
+
+	def _drainNotifications(self):
+		'''Process notifications, which DS has sent already (e.g. changes by buttons), so cache is current; the reader thread does it by itself'''
+		if self._reader is not None:
+			return
+		fileno = _helperFileno(self.connection)
+		if fileno is not None:
+			try:
+				if not select.select([fileno], [], [], 0)[0]:
+					return
+			except (select.error, ValueError, OSError):
+				return
+		# Other holder of the connection processes notifications anyway
+		if not self._lock.acquire(False):
+			return
+		try:
+			while self._communicate(self.connection.waitForNotifications, READER_SLICE):
+				pass
+		finally:
+			self._lock.release()
+
+	def _communicate(self, function, *args):
+		'''Call function of the connection; if the link is dropped, reconnect (when enabled) and call it again'''
+		while True:
+			try:
+				return function(*args)
+			except btle.BTLEException as e:
+				if (self._reconnect is None) or self._reconnecting or getattr(self._deferReconnect, 'active', False) or not _isDisconnect(e):
+					raise
+				self.log.debug('_communicate: %s', e)
+				self.Reconnect()
+
+	def EnableReconnect(self, attempts=RECONNECT_ATTEMPTS, delay=RECONNECT_DELAY, maxDelay=MAX_RECONNECT_DELAY):
+		'''Reconnect automatically, when the link is dropped'''
+		self.log.debug('EnableReconnect(%s, %s, %s)', attempts, delay, maxDelay)
+		assert (attempts is None) or (isinstance(attempts, int) and (attempts > 0)), 'attempts must be positive int or None: %r' % attempts
+		assert (delay >= 0) and (maxDelay >= delay), 'delay must be between 0 and maxDelay: %r' % delay
+		self._reconnect = (attempts, delay, maxDelay)
+		return self
+
+	def DisableReconnect(self):
+		self.log.debug('DisableReconnect')
+		self._reconnect = None
+		return self
+
+	def Reconnect(self):
+		'''Reconnect with exponential backoff, restore notifications, re-apply desired state and replay pending read-commands
+
+		Raise the last BTLEException, if all attempts failed.
+		'''
+		self.log.debug('Reconnect(%s)', self.address)
+		(attempts, delay, maxDelay) = self._reconnect if self._reconnect is not None else (RECONNECT_ATTEMPTS, RECONNECT_DELAY, MAX_RECONNECT_DELAY)
+		with self._lock:
+			self._reconnecting = True
+			try:
+				attempt = 0
+				while True:
+					attempt += 1
+					try:
+						try:
+							self.connection.disconnect()
+						except btle.BTLEException:
+							pass
+						self.connection.connect(self.address, self._addrType, self._iface)
+						self._setup()
+						self._replay()
+						break
+					except btle.BTLEException as e:
+						self.log.debug('Reconnect: attempt %d: %s', attempt, e)
+						if (attempts is not None) and (attempt >= attempts):
+							raise
+					time.sleep(delay)
+					delay = min(delay * 2, maxDelay)
+			finally:
+				self._reconnecting = False
+			self.reconnects += 1
+		if (self._readerPoll is not None) and (self._reader is None):
+			# Reader thread was stopped by the drop
+			self.StartReader(self._readerPoll)
+		# Response is not waited for: Reconnect may run on the reader thread or under the connection lock
+		self._rememberHandles()
+		return self
+
+	def Close(self):
+		'''Stop reader, verify and write coalescing threads, then disconnect; queued writes are flushed, if the link allows'''
+		self.log.debug('Close')
+		# Dead link must not be reconnected by the threads being stopped
+		self._reconnect = None
+		self.StopReader()
+		self._stopVerify()
+		try:
+			self.DisableWriteCoalescing()
+		except btle.BTLEException as e:
+			self.log.debug('Close: %s', e)
+		try:
+			self.connection.disconnect()
+		except btle.BTLEException:
+			pass
+		return self
+
+	def _desire(self, command, value):
+		'''Remember value of setting, written by application'''
+		if (value is None) or ((command == Command.MODE) and (value == Mode.IDENTIFY)):
+			return
+		self._desired[command] = value
+		if command in _WRITE_SIDE_EFFECTS:
+			# Mode switched by the write is desired too, replay must not restore the previous one
+			(sideCommand, sideValue) = _WRITE_SIDE_EFFECTS[command]
+			self._desired[sideCommand] = sideValue
+
+	def _replay(self):
+		'''Re-apply desired state to DS and retransmit read-commands in flight'''
+		self.cache.Invalidate()
+		self._quietUntil = 0.0
+		probe = self._handlesProbe
+		if probe is not None:
+			# Not retransmitted, _rememberHandles submits a new one for handles of this connection
+			self._handlesProbe = None
+			with self._pendingLock:
+				try:
+					self._pending[probe.command].remove(probe)
+				except ValueError:
+					pass
+		writes = [(command, self._desired[command]) for (name, command) in SNAPSHOT_FIELDS if command in self._desired]
+		for (command, value) in writes:
+			self._transmitWrite(command, EncodeFrameUnchecked(command, CommandDirection.WRITE, value), value, 0)
+		if writes:
+			self._quietUntil = time.time() + WRITE_TIMEOUT
+		self._pause(self._quietUntil)
+		with self._pendingLock:
+			requests = sorted([request for pending in self._pending.values() for request in pending], key=lambda request: request.sent)
+		now = time.time()
+		for request in requests:
+			# Keep timeout of request from now
+			request.deadline = now + (request.deadline - request.sent)
+			request.sent = now
+			if request is self._submitting:
+				# Its transmission failed by the drop, it is repeated by _communicate
+				continue
+			self._transmitFrame(request.command, CommandDirection.READ, EncodeFrame(request.command, CommandDirection.READ))
+
+	def StartReader(self, poll=READER_POLL):
+		'''Start background thread, which reads notifications continuously'''
+		self.log.debug('StartReader')
+		self._readerPoll = poll
+		if self._reader is not None:
+			return self
+		self._readerStop.clear()
+		self._ring = deque(maxlen=READER_BUFFER_SIZE)
+		self._reader = threading.Thread(target=self._readLoop, args=(poll,))
+		self._reader.daemon = True
+		self._reader.start()
+		return self
+
+	def StopReader(self):
+		self.log.debug('StopReader')
+		self._readerPoll = None
+		thread = self._reader
+		if thread is None:
+			return self
+		self._readerStop.set()
+		if thread is not threading.current_thread():
+			thread.join()
+		self._reader = None
+		self._ring = None
+		return self
+
+	def _readLoop(self, poll):
+		try:
+			self._readNotifications(poll)
+		finally:
+			with self._notified:
+				if self._reader is threading.current_thread():
+					# Stopped by BTLEException: waiting callers read the connection themselves again
+					self._reader = None
+					self._ring = None
+				self._notified.notify_all()
+
+	def _readNotifications(self, poll):
+		while not self._readerStop.is_set():
+			# bluepy-helper is restarted on reconnect
+			fileno = _helperFileno(self.connection)
+			try:
+				if fileno is not None:
+					# Wait for output of bluepy-helper without holding the connection
+					try:
+						select.select([fileno], [], [], poll)
+					except (select.error, ValueError, OSError):
+						pass
+				with self._lock:
+					# Notifications are appended to ring by dispatcher
+					while self._communicate(self.connection.waitForNotifications, READER_SLICE):
+						pass
+			except btle.BTLEException as e:
+				self.log.debug('_readLoop: %s', e)
+				self._readerStop.set()
+			if not self._ring:
+				if fileno is None:
+					# Let commands take the connection between polls
+					time.sleep(READER_SLICE)
+				continue
+			self._dispatchRing()
+		self._dispatchRing()
+
+	def _dispatchRing(self):
+		ring = self._ring
+		while ring:
+			(cHandle, data) = ring.popleft()
+			self._dispatcher.Dispatch(cHandle, data)
+			with self._notified:
+				self._dispatched += 1
+				self._notified.notify_all()
 		
-	def _transmitCommand(self, command, direction=CommandDirection.READ, argument=''):
+	def _transmitFrame(self, command, direction, frame):
+		'''Transmit frame encoded by EncodeFrame'''
+		self.log.debug('_transmitFrame(%r)', frame)
+		self._lockQuiet()
+		try:
+			# Characteristic is replaced on reconnect
+			self._communicate(lambda: self.ds_command_char.write(frame))
+		finally:
+			self._lock.release()
+		self.metrics.Transmitted(command, direction, len(frame))
+		return self
+
+	def _lockQuiet(self):
+		'''Take the connection after the pause after write-command; the pause is kept without it, so the reader thread polls meanwhile'''
+		while True:
+			self._pause(self._quietUntil)
+			self._lock.acquire()
+			if self._quietUntil <= time.time():
+				return
+			# Written by other thread meanwhile
+			self._lock.release()
+
+	def _pause(self, until):
+		'''Process notifications until the given time'''
+		while True:
+			remaining = until - time.time()
+			if remaining <= 0:
+				return
+			self.WaitForNotifications(remaining)
+
+	def _handleResponse(self, response):
+		self.cache.Set(response.command, response.value)
+		if response.command == Command.VERSION_NUMBER:
+			self._checkFirmware(response.value)
+		if (response.direction == CommandDirection.USER) and (response.command in self._desired):
+			# Change by DS buttons overrides the one by application
+			self._desired[response.command] = response.value
+		if response.direction == CommandDirection.USER:
+			with self._unverifiedLock:
+				self._unverified.pop(response.command, None)
+		if response.direction != CommandDirection.READ:
+			return None
+		with self._pendingLock:
+			pending = self._pending[response.command]
+			if not pending:
+				self.log.debug('_handleResponse: unsolicited %s', response.command.name)
+				return None
+			request = pending.popleft()
+		latency = time.time() - request.sent
+		self.rtt.Sample(latency)
+		self.metrics.Answered(response.command, latency)
+		request._complete(response)
+		return request
+
+	def _expire(self, request):
+		if request.done:
+			return
+		self.log.debug('_expire(%s)', request.command.value)
+		with self._pendingLock:
+			try:
+				self._pending[request.command].remove(request)
+			except ValueError:
+				pass
+		self.rtt.Backoff()
+		self.metrics.TimedOut(request.command)
+		request._complete(None)
+
+	def SubmitCommand(self, command, timeout=None, callback=None):
 		assert isinstance(command, Command), 'command must be Commands: %r' % command
-		assert isinstance(direction, CommandDirection), 'direction must be CommandDirection: %r' % direction
-		assert isinstance(argument, str), 'argument must be string: %r' % argument
-		DBG('_transmitCommand(%s, %s, %s)' % (command.value, direction.value, argument))
-		self.ds_command_char.write(('%s%s%s%s' % (COMMAND_CHAR, command.value, direction.value, argument)).encode('UTF-8'))
+		self.log.debug('SubmitCommand(%s)', command.value)
+		if timeout is None:
+			timeout = self.rtt.timeout
+		# Keep pause after write-command before the request is timed
+		self._lockQuiet()
+		try:
+			self._expireProbe()
+			request = PendingCommand(command, time.time() + timeout, callback)
+			with self._pendingLock:
+				self._pending[command].append(request)
+			# Replay on reconnect by _transmitFrame skips it, _communicate repeats the transmission
+			self._submitting = request
+			try:
+				self._transmitFrame(command, CommandDirection.READ, EncodeFrame(command, CommandDirection.READ))
+			except:
+				with self._pendingLock:
+					self._pending[command].remove(request)
+				raise
+			finally:
+				self._submitting = None
+		finally:
+			self._lock.release()
+		return request
+
+	def WaitForResponses(self, requests):
+		while True:
+			waiting = [request for request in requests if not request.done]
+			if not waiting:
+				return requests
+			now = time.time()
+			deadline = min(request.deadline for request in waiting)
+			if deadline <= now:
+				for request in waiting:
+					if request.deadline <= now:
+						self._expire(request)
+				continue
+			if self._reader is not None:
+				self._waitForDispatch(waiting, deadline - now)
+			else:
+				self.WaitForNotifications(deadline - now)
+
+	def _waitForDispatch(self, requests, timeout):
+		'''Wait for completion of any of requests by the reader thread'''
+		with self._notified:
+			if not any(request.done for request in requests):
+				self._notified.wait(timeout)
+
+	def ReadCommands(self, commands, timeout=None):
+		if self.log.isEnabledFor(logging.DEBUG):
+			self.log.debug('ReadCommands(%s)', ''.join(command.value for command in commands))
+		return self.WaitForResponses([self.SubmitCommand(command, timeout) for command in commands])
+
+	def _transmitWrite(self, command, frame, value, timeout):
+		self._transmitFrame(command, CommandDirection.WRITE, frame)
+		self.cache.Written(command, value)
+		self._quietUntil = time.time() + timeout
+		return self
+
+	def _writeCommandNWait(self, command, frame, timeout=WRITE_TIMEOUT, value=None, force=False, delivery=None):
+		self.log.debug('_writeCommandNWait(%s)', command.value)
+		if delivery is None:
+			delivery = self.delivery
+		assert isinstance(delivery, Delivery), 'delivery must be Delivery: %r' % delivery
+		self._desire(command, value)
+		if not force:
+			# Cache must know changes by buttons to tell, if the write is in effect
+			self._drainNotifications()
+		if self._flushThread is not None:
+			return self._queueWrite(command, frame, value, force)
+		if (not force) and self.cache.InEffect(command, value):
+			self.log.debug('_writeCommandNWait(%s): skipped', command.value)
+			self.skippedWrites += 1
+			return self
+		if delivery == Delivery.FIRE_AND_FORGET:
+			return self._transmitUnacked(command, frame, value)
+		self._transmitWrite(command, frame, value, timeout)
+		if delivery == Delivery.CONFIRMED:
+			self._confirmWrite(command, value)
+		return self
+
+	def _transmitUnacked(self, command, frame, value):
+		'''Write frame straight to command handle without response and pause, remember value to verify'''
+		self.log.debug('_transmitUnacked(%r)', frame)
+		with self._lock:
+			# Characteristic is replaced on reconnect
+			self._communicate(lambda: self.connection.writeCharacteristic(self.ds_command_char.valHandle, frame, False))
+		self.metrics.Transmitted(command, CommandDirection.WRITE, len(frame))
+		self.cache.Written(command, value)
+		with self._unverifiedLock:
+			if command in _WRITE_SIDE_EFFECTS:
+				# Mode is switched by this write, the one written before is not expected anymore
+				self._unverified.pop(_WRITE_SIDE_EFFECTS[command][0], None)
+			if not ((command == Command.MODE) and (value == Mode.IDENTIFY)):
+				self._unverified.pop(command, None)
+				self._unverified[command] = value
+		return self
+
+	def _confirmWrite(self, command, value):
+		'''Read back value written by command, count it if DS has another one'''
+		if (command == Command.MODE) and (value == Mode.IDENTIFY):
+			# IDENTIFY mode returns to the previous one by itself, it can not be confirmed
+			return True
+		response = self.WaitForResponses([self.SubmitCommand(command)])[0].response
+		if (response is not None) and (response.value == value):
+			return True
+		self.log.debug('_confirmWrite(%s): %s', command.value, None if response is None else response.value)
+		self.unconfirmedWrites += 1
+		return False
+
+	def SetDelivery(self, delivery, verifyInterval=VERIFY_INTERVAL):
+		'''Set default delivery of Set* methods; fire-and-forget writes are verified every verifyInterval seconds (None - only by VerifyWrites)'''
+		assert isinstance(delivery, Delivery), 'delivery must be Delivery: %r' % delivery
+		assert (verifyInterval is None) or (verifyInterval > 0), 'verifyInterval must be positive: %r' % verifyInterval
+		self.log.debug('SetDelivery(%s, %s)', delivery.value, verifyInterval)
+		self.delivery = delivery
+		self._stopVerify()
+		if (delivery == Delivery.FIRE_AND_FORGET) and (verifyInterval is not None):
+			self._verifyStop.clear()
+			self._verifyThread = threading.Thread(target=self._verifyLoop, args=(verifyInterval,))
+			self._verifyThread.daemon = True
+			self._verifyThread.start()
+		return self
+
+	def _stopVerify(self):
+		thread = self._verifyThread
+		if thread is None:
+			return
+		self._verifyThread = None
+		self._verifyStop.set()
+		if thread is not threading.current_thread():
+			thread.join()
+
+	def _verifyLoop(self, interval):
+		while not self._verifyStop.wait(interval):
+			try:
+				self.VerifyWrites()
+			except btle.BTLEException as e:
+				self.log.debug('_verifyLoop: %s', e)
+
+	def VerifyWrites(self, timeout=None, resend=True):
+		'''Read back settings written fire-and-forget with pipelined read-commands, resend the ones DS does not have
+
+		Return dict of success by Command; the ones without response stay to be verified again.
+		'''
+		with self._unverifiedLock:
+			unverified = list(self._unverified.items())
+		if not unverified:
+			return {}
+		self.log.debug('VerifyWrites(%d)', len(unverified))
+		results = {}
+		for (request, (command, value)) in zip(self.ReadCommands([command for (command, value) in unverified], timeout), unverified):
+			if request.response is None:
+				results[command] = False
+				continue
+			results[command] = (request.response.value == value)
+			with self._unverifiedLock:
+				if self._unverified.get(command) != value:
+					# Written again or changed by DS buttons meanwhile
+					continue
+				del self._unverified[command]
+			if not results[command]:
+				self.lostWrites += 1
+				if resend:
+					self._transmitUnacked(command, EncodeFrameUnchecked(command, CommandDirection.WRITE, value), value)
+		return results
+
+	def _queueWrite(self, command, frame, value, force):
+		with self._queuedWritesCondition:
+			queued = command in self._queuedWrites
+			if (not force) and self.cache.InEffect(command, value):
+				# DS already has this value, drop the queued one, if any
+				self._queuedWrites.pop(command, None)
+				self.skippedWrites += 1
+			else:
+				self._queuedWrites[command] = (frame, value)
+				self._queuedWritesCondition.notify()
+			if queued:
+				self.coalescedWrites += 1
 		return self
 
-	def _writeCommandNWait(self, command, argument, timeout=WRITE_TIMEOUT):
-		DBG('_writeCommandNWait(%s)' % command.value)
-		self._transmitCommand(command, CommandDirection.WRITE, argument).WaitForNotifications(timeout)
+	def _popQueuedWrite(self, block):
+		with self._queuedWritesCondition:
+			while block and (not self._queuedWrites) and (self._flushThread is not None):
+				self._queuedWritesCondition.wait()
+			if not self._queuedWrites:
+				return None
+			return self._queuedWrites.popitem(last=False)
+
+	def _flushLoop(self):
+		while True:
+			write = self._popQueuedWrite(True)
+			if write is None:
+				return
+			(command, (frame, value)) = write
+			try:
+				self._transmitWrite(command, frame, value, self._flushInterval)
+			except btle.BTLEException as e:
+				self.log.debug('_flushLoop: %s', e)
+				with self._queuedWritesCondition:
+					# Write stays queued, unless a newer value replaced it meanwhile
+					if command not in self._queuedWrites:
+						self._queuedWrites[command] = (frame, value)
+					if self._flushThread is None:
+						# Disabled: the queue is left to FlushWrites
+						return
+					# Link is down, try again later
+					self._queuedWritesCondition.wait(RECONNECT_DELAY)
+
+	def EnableWriteCoalescing(self, interval=WRITE_TIMEOUT):
+		self.log.debug('EnableWriteCoalescing(%s)', interval)
+		assert (interval > 0), 'interval must be positive: %r' % interval
+		self._flushInterval = interval
+		if self._flushThread is not None:
+			return self
+		self._flushThread = threading.Thread(target=self._flushLoop)
+		self._flushThread.daemon = True
+		self._flushThread.start()
 		return self
 
-	def _readCommandNWait(self, command, timeout=READ_TIMEOUT):
-		DBG('_readCommandNWait(%s)' % command.value)
-		return self._transmitCommand(command, CommandDirection.READ).WaitForNotifications(timeout)
+	def DisableWriteCoalescing(self):
+		self.log.debug('DisableWriteCoalescing')
+		thread = self._flushThread
+		if thread is None:
+			return self
+		with self._queuedWritesCondition:
+			self._flushThread = None
+			self._queuedWritesCondition.notify()
+		thread.join()
+		return self.FlushWrites()
+
+	def FlushWrites(self):
+		self.log.debug('FlushWrites')
+		while True:
+			write = self._popQueuedWrite(False)
+			if write is None:
+				return self
+			(command, (frame, value)) = write
+			self._transmitWrite(command, frame, value, self._flushInterval)
+
+	def WriteCommands(self, writes, timeout=None, confirm=True, force=False):
+		'''Transmit all (command, value) writes without pauses between them, then confirm them with pipelined read-back after the pause
+
+		Return dict of success by Command. Writes already in effect are skipped, unless force is True.
+		'''
+		if self.log.isEnabledFor(logging.DEBUG):
+			self.log.debug('WriteCommands(%s)', ''.join(command.value for (command, value) in writes))
+		results = {}
+		written = OrderedDict()
+		# Switching of mode by writes does not matter, if the mode is written too
+		sideEffects = Command.MODE not in [command for (command, value) in writes]
+		if not force:
+			self._drainNotifications()
+		for (command, value) in writes:
+			self._desire(command, value)
+			if (not force) and self.cache.InEffect(command, value, sideEffects):
+				self.skippedWrites += 1
+				results[command] = True
+				continue
+			self._transmitWrite(command, EncodeFrame(command, CommandDirection.WRITE, value), value, 0)
+			written[command] = value
+		if written:
+			# DS needs the pause after the last write, read-back waits for it
+			self._quietUntil = time.time() + WRITE_TIMEOUT
+		if not confirm:
+			results.update((command, True) for command in written)
+			return results
+		# IDENTIFY mode returns to the previous one by itself, it can not be confirmed
+		confirmed = [command for (command, value) in written.items() if not ((command == Command.MODE) and (value == Mode.IDENTIFY))]
+		results.update((command, True) for command in written if command not in confirmed)
+		for request in self.ReadCommands(confirmed, timeout):
+			results[request.command] = (request.response is not None) and (request.response.value == written[request.command])
+		return results
+
+	def Snapshot(self, timeout=None):
+		'''Read all settings of DS at once, return Snapshot'''
+		self.log.debug('Snapshot')
+		requests = self.ReadCommands([command for (name, command) in _SNAPSHOT_COMMANDS], timeout)
+		return Snapshot(**dict((name, request.response.value) for ((name, command), request) in zip(_SNAPSHOT_COMMANDS, requests) if request.response is not None))
+
+	def Restore(self, snapshot, timeout=None, confirm=True):
+		'''Write back fields of snapshot, which differ from the current state of DS; return dict of success by Command'''
+		assert isinstance(snapshot, Snapshot), 'snapshot must be Snapshot: %r' % snapshot
+		self.log.debug('Restore')
+		self.Snapshot(timeout)
+		return self.WriteCommands(snapshot.Writes(), timeout, confirm)
+
+	def _readCommandNWait(self, command, timeout=None, fresh=False):
+		self.log.debug('_readCommandNWait(%s)', command.value)
+		if not fresh:
+			self._drainNotifications()
+			value = self.cache.Get(command)
+			if value is not None:
+				return value
+		response = self.WaitForResponses([self.SubmitCommand(command, timeout)])[0].response
+		return None if response is None else response.value
 
-	def SetMode(self, mode, timeout=WRITE_TIMEOUT):
-		assert isinstance(mode, Mode), 'mode must be Mode: %r' % mode
-		DBG('SetMode(%d)' % mode.value)
-		return self._writeCommandNWait(Command.MODE, '%d' % mode.value, timeout)
+	def SetMode(self, mode, timeout=WRITE_TIMEOUT, force=False, delivery=None):
+		frame = EncodeFrame(Command.MODE, CommandDirection.WRITE, mode)
+		self.log.debug('SetMode(%d)', mode.value)
+		return self._writeCommandNWait(Command.MODE, frame, timeout, mode, force, delivery)
 
-	def GetMode(self, timeout=READ_TIMEOUT):
-		DBG('GetMode')
-		return self._readCommandNWait(Command.MODE, timeout)
+	def GetMode(self, timeout=None, fresh=False):
+		self.log.debug('GetMode')
+		return self._readCommandNWait(Command.MODE, timeout, fresh)
 		
-	def SetBrightness(self, brightness, timeout=WRITE_TIMEOUT):
-		assert (isinstance(brightness, int) and (brightness >= 0) and (brightness <= 100)), 'brightness must be int between 0 and 100: %r' % brightness
-		DBG('SetBrightness(%d)' % brightness)
-		return self._writeCommandNWait(Command.BRIGHTNESS, '%03d' % brightness, timeout)
-
-	def GetBrightness(self, timeout=READ_TIMEOUT):
-		DBG('GetBrightness')
-		return self._readCommandNWait(Command.BRIGHTNESS, timeout)
+	def SetBrightness(self, brightness, timeout=WRITE_TIMEOUT, force=False, delivery=None):
+		frame = EncodeFrame(Command.BRIGHTNESS, CommandDirection.WRITE, brightness)
+		self.log.debug('SetBrightness(%d)', brightness)
+		return self._writeCommandNWait(Command.BRIGHTNESS, frame, timeout, brightness, force, delivery)
+
+	def GetBrightness(self, timeout=None, fresh=False):
+		self.log.debug('GetBrightness')
+		return self._readCommandNWait(Command.BRIGHTNESS, timeout, fresh)
 		
-	def SetZone(self, top, bottom, left, right, timeout=WRITE_TIMEOUT):
-		assert isinstance(top, bool), 'top must be bool: %r' % top
-		assert isinstance(bottom, bool), 'bottom must be bool: %r' % bottom
-		assert isinstance(left, bool), 'left must be bool: %r' % left
-		assert isinstance(right, bool), 'right must be bool: %r' % right
-		DBG('SetZone(%s, %s, %s, %s)' % (top, bottom, left, right))
-		return self._writeCommandNWait(Command.ZONE, ('y' if top else 'n') + ('y' if bottom else 'n') + ('y' if left else 'n') + ('y' if right else 'n'))
-
-	def GetZone(self, timeout=READ_TIMEOUT):
-		DBG('GetZone')
-		return self._readCommandNWait(Command.ZONE, timeout)
+	def SetZone(self, top, bottom, left, right, timeout=WRITE_TIMEOUT, force=False, delivery=None):
+		zone = Zone(top, bottom, left, right)
+		frame = EncodeFrame(Command.ZONE, CommandDirection.WRITE, zone)
+		self.log.debug('SetZone(%s, %s, %s, %s)', top, bottom, left, right)
+		return self._writeCommandNWait(Command.ZONE, frame, timeout, zone, force, delivery)
+
+	def GetZone(self, timeout=None, fresh=False):
+		self.log.debug('GetZone')
+		return self._readCommandNWait(Command.ZONE, timeout, fresh)
 		
-	def SetAmblientColor(self, red, green, blue, timeout=WRITE_TIMEOUT):
-		assert (isinstance(red, int) and (red >= 0) and (red <= 255)), 'red must be int between 0 and 255: %r' % red
-		assert (isinstance(green, int) and (green >= 0) and (green <= 255)), 'green must be int between 0 and 255: %r' % green
-		assert (isinstance(blue, int) and (blue >= 0) and (blue <= 255)), 'blue must be int between 0 and 255: %r' % blue
-		DBG('SetAmblientColor(%d, %d, %d)' % (red, green, blue))
-		return self._writeCommandNWait(Command.AMBIENT_COLOR, '%03d%03d%03d' % (red, green, blue), timeout)
-
-	def GetAmblientColor(self, timeout=READ_TIMEOUT):
-		DBG('GetAmblientColor')
-		return self._readCommandNWait(Command.AMBIENT_COLOR, timeout)
+	def SetAmblientColor(self, red, green, blue, timeout=WRITE_TIMEOUT, force=False, delivery=None):
+		color = RGB(red, green, blue)
+		frame = EncodeFrame(Command.AMBIENT_COLOR, CommandDirection.WRITE, color)
+		self.log.debug('SetAmblientColor(%d, %d, %d)', red, green, blue)
+		return self._writeCommandNWait(Command.AMBIENT_COLOR, frame, timeout, color, force, delivery)
+
+	def GetAmblientColor(self, timeout=None, fresh=False):
+		self.log.debug('GetAmblientColor')
+		return self._readCommandNWait(Command.AMBIENT_COLOR, timeout, fresh)
 		
-	def SetSaturation(self, red, green, blue, timeout=WRITE_TIMEOUT):
-		assert (isinstance(red, int) and (red >= 0) and (red <= 255)), 'red must be int between 0 and 255: %r' % red
-		assert (isinstance(green, int) and (green >= 0) and (green <= 255)), 'green must be int between 0 and 255: %r' % green
-		assert (isinstance(blue, int) and (blue >= 0) and (blue <= 255)), 'blue must be int between 0 and 255: %r' % blue
-		DBG('SetSaturation(%d, %d, %d)' % (red, green, blue))
-		return self._writeCommandNWait(Command.SATURATION, '%03d%03d%03d' % (red, green, blue), timeout)
-
-	def GetSaturation(self, timeout=READ_TIMEOUT):
-		DBG('GetSaturation')
-		return self._readCommandNWait(Command.SATURATION, timeout)
+	def SetSaturation(self, red, green, blue, timeout=WRITE_TIMEOUT, force=False, delivery=None):
+		color = RGB(red, green, blue)
+		frame = EncodeFrame(Command.SATURATION, CommandDirection.WRITE, color)
+		self.log.debug('SetSaturation(%d, %d, %d)', red, green, blue)
+		return self._writeCommandNWait(Command.SATURATION, frame, timeout, color, force, delivery)
+
+	def GetSaturation(self, timeout=None, fresh=False):
+		self.log.debug('GetSaturation')
+		return self._readCommandNWait(Command.SATURATION, timeout, fresh)
 		
-	def SetSKU(self, sku, timeout=WRITE_TIMEOUT):
-		assert isinstance(sku, SKU), 'sku must be SKU: %r' % sku
-		DBG('SetSKU(%d)' % sku.value)
-		return self._writeCommandNWait(Command.SKU, '%d' % sku.value, timeout)
-
-	def GetSKU(self, timeout=READ_TIMEOUT):
-		DBG('GetSKU')
-		return self._readCommandNWait(Command.SKU, timeout)
+	def SetSKU(self, sku, timeout=WRITE_TIMEOUT, force=False, delivery=None):
+		frame = EncodeFrame(Command.SKU, CommandDirection.WRITE, sku)
+		self.log.debug('SetSKU(%d)', sku.value)
+		return self._writeCommandNWait(Command.SKU, frame, timeout, sku, force, delivery)
+
+	def GetSKU(self, timeout=None, fresh=False):
+		self.log.debug('GetSKU')
+		return self._readCommandNWait(Command.SKU, timeout, fresh)
 		
-	def SetCustomLEDCount(self, vertical, horizontal, customLEDMode, timeout=WRITE_TIMEOUT):
-		assert (isinstance(vertical, int) and (vertical >= 8) and (vertical <= 32)), 'vertical must be int between 8 and 32: %r' % vertical
-		assert (isinstance(horizontal, int) and (horizontal >= 14) and (horizontal <= 60)), 'horizontal must be int between 14 and 60: %r' % horizontal
-		assert isinstance(customLEDMode, CustomLEDMode), 'customLEDMode must be CustomLEDMode: %r' % customLEDMode
-		DBG('SetCustomLEDCount(%d, %d, %s)' % (vertical, horizontal, customLEDMode.value))
-		return self._writeCommandNWait(Command.CUSTOM_LED_COUNT, '%03d%03d%s' % (vertical, horizontal, customLEDMode.value), timeout)
-
-	def GetCustomLEDCount(self, timeout=READ_TIMEOUT):
-		DBG('GetCustomLEDCount')
-		return self._readCommandNWait(Command.CUSTOM_LED_COUNT, timeout)
+	def SetCustomLEDCount(self, vertical, horizontal, customLEDMode, timeout=WRITE_TIMEOUT, force=False, delivery=None):
+		customLEDCount = CustomLEDCount(vertical, horizontal, customLEDMode)
+		frame = EncodeFrame(Command.CUSTOM_LED_COUNT, CommandDirection.WRITE, customLEDCount)
+		self.log.debug('SetCustomLEDCount(%d, %d, %s)', vertical, horizontal, customLEDMode.value)
+		return self._writeCommandNWait(Command.CUSTOM_LED_COUNT, frame, timeout, customLEDCount, force, delivery)
+
+	def GetCustomLEDCount(self, timeout=None, fresh=False):
+		self.log.debug('GetCustomLEDCount')
+		return self._readCommandNWait(Command.CUSTOM_LED_COUNT, timeout, fresh)
 		
-	def SetMusicModeType(self, musicModeType, timeout=WRITE_TIMEOUT):
-		assert isinstance(musicModeType, MusicModeType), 'musicModeType must be MusicModeType: %r' % musicModeType
-		DBG('SetMusicModeType(%d)' % musicModeType.value)
-		return self._writeCommandNWait(Command.MUSIC_MODE_TYPE, '%d' % musicModeType.value, timeout)
-
-	def GetMusicModeType(self, timeout=READ_TIMEOUT):
-		DBG('GetMusicModeType')
-		return self._readCommandNWait(Command.MUSIC_MODE_TYPE, timeout)
+	def SetMusicModeType(self, musicModeType, timeout=WRITE_TIMEOUT, force=False, delivery=None):
+		frame = EncodeFrame(Command.MUSIC_MODE_TYPE, CommandDirection.WRITE, musicModeType)
+		self.log.debug('SetMusicModeType(%d)', musicModeType.value)
+		return self._writeCommandNWait(Command.MUSIC_MODE_TYPE, frame, timeout, musicModeType, force, delivery)
+
+	def GetMusicModeType(self, timeout=None, fresh=False):
+		self.log.debug('GetMusicModeType')
+		return self._readCommandNWait(Command.MUSIC_MODE_TYPE, timeout, fresh)
 		
-	def SetMusicModeColor(self, treble, middle, bass, timeout=WRITE_TIMEOUT):
-		assert isinstance(treble, MusicModeColor), 'treble must be MusicModeColor: %r' % treble
-		assert isinstance(middle, MusicModeColor), 'middle must be MusicModeColor: %r' % middle
-		assert isinstance(bass, MusicModeColor), 'bass must be MusicModeColor: %r' % bass
-		DBG('SetMusicModeColor(%d, %d, %d)' % (treble.value, middle.value, bass.value))
-		return self._writeCommandNWait(Command.MUSIC_MODE_COLOR, '%d%d%d' % (treble.value, middle.value, bass.value), timeout)
-
-	def GetMusicModeColor(self, timeout=READ_TIMEOUT):
-		DBG('GetMusicModeColor')
-		return self._readCommandNWait(Command.MUSIC_MODE_COLOR, timeout)
+	def SetMusicModeColor(self, treble, middle, bass, timeout=WRITE_TIMEOUT, force=False, delivery=None):
+		colors = MusicModeColors(treble, middle, bass)
+		frame = EncodeFrame(Command.MUSIC_MODE_COLOR, CommandDirection.WRITE, colors)
+		self.log.debug('SetMusicModeColor(%d, %d, %d)', treble.value, middle.value, bass.value)
+		return self._writeCommandNWait(Command.MUSIC_MODE_COLOR, frame, timeout, colors, force, delivery)
+
+	def GetMusicModeColor(self, timeout=None, fresh=False):
+		self.log.debug('GetMusicModeColor')
+		return self._readCommandNWait(Command.MUSIC_MODE_COLOR, timeout, fresh)
 		
-	def SetVideoMinimumIntensity(self, red, green, blue, timeout=WRITE_TIMEOUT):
-		assert (isinstance(red, int) and (red >= 0) and (red <= 50)), 'red must be int between 0 and 50: %r' % red
-		assert (isinstance(green, int) and (green >= 0) and (green <= 50)), 'green must be int between 0 and 50: %r' % green
-		assert (isinstance(blue, int) and (blue >= 0) and (blue <= 50)), 'blue must be int between 0 and 50: %r' % blue
-		DBG('SetVideoMinimumIntensity(%d, %d, %d)' % (red, green, blue))
-		return self._writeCommandNWait(Command.VIDEO_MINIMUM_INTENSITY, '%03d%03d%03d' % (red, green, blue), timeout)
-
-	def GetVideoMinimumIntensity(self, timeout=READ_TIMEOUT):
-		DBG('GetVideoMinimumIntensity')
-		return self._readCommandNWait(Command.VIDEO_MINIMUM_INTENSITY, timeout)
+	def SetVideoMinimumIntensity(self, red, green, blue, timeout=WRITE_TIMEOUT, force=False, delivery=None):
+		color = RGB(red, green, blue)
+		frame = EncodeFrame(Command.VIDEO_MINIMUM_INTENSITY, CommandDirection.WRITE, color)
+		self.log.debug('SetVideoMinimumIntensity(%d, %d, %d)', red, green, blue)
+		return self._writeCommandNWait(Command.VIDEO_MINIMUM_INTENSITY, frame, timeout, color, force, delivery)
+
+	def GetVideoMinimumIntensity(self, timeout=None, fresh=False):
+		self.log.debug('GetVideoMinimumIntensity')
+		return self._readCommandNWait(Command.VIDEO_MINIMUM_INTENSITY, timeout, fresh)
 		
-	def SetAmbientShowType(self, ambientShowType, timeout=WRITE_TIMEOUT):
-		assert isinstance(ambientShowType, AmbientShowType), 'ambientShowType must be AmbientShowType: %r' % ambientShowType
-		DBG('SetAmbientShowType(%d)' % ambientShowType.value)
-		return self._writeCommandNWait(Command.AMBIENT_SHOW_TYPE, '%d' % ambientShowType.value, timeout)
-
-	def GetAmbientShowType(self, timeout=READ_TIMEOUT):
-		DBG('GetAmbientShowType')
-		return self._readCommandNWait(Command.AMBIENT_SHOW_TYPE, timeout)
+	def SetAmbientShowType(self, ambientShowType, timeout=WRITE_TIMEOUT, force=False, delivery=None):
+		frame = EncodeFrame(Command.AMBIENT_SHOW_TYPE, CommandDirection.WRITE, ambientShowType)
+		self.log.debug('SetAmbientShowType(%d)', ambientShowType.value)
+		return self._writeCommandNWait(Command.AMBIENT_SHOW_TYPE, frame, timeout, ambientShowType, force, delivery)
+
+	def GetAmbientShowType(self, timeout=None, fresh=False):
+		self.log.debug('GetAmbientShowType')
+		return self._readCommandNWait(Command.AMBIENT_SHOW_TYPE, timeout, fresh)
 		
-	def SetFadeRate(self, fadeRate, timeout=WRITE_TIMEOUT):
-		assert (isinstance(fadeRate, int) and (fadeRate >= 4) and (fadeRate <= 50)), 'fadeRate must be int between 4 and 50: %r' % fadeRate
-		DBG('SetFadeRate(%d)' % fadeRate)
-		return self._writeCommandNWait(Command.FADE_RATE, '%03d' % fadeRate, timeout)
-
-	def GetFadeRate(self, timeout=READ_TIMEOUT):
-		DBG('GetFadeRate')
-		return self._readCommandNWait(Command.FADE_RATE, timeout)
+	def SetFadeRate(self, fadeRate, timeout=WRITE_TIMEOUT, force=False, delivery=None):
+		frame = EncodeFrame(Command.FADE_RATE, CommandDirection.WRITE, fadeRate)
+		self.log.debug('SetFadeRate(%d)', fadeRate)
+		return self._writeCommandNWait(Command.FADE_RATE, frame, timeout, fadeRate, force, delivery)
+
+	def GetFadeRate(self, timeout=None, fresh=False):
+		self.log.debug('GetFadeRate')
+		return self._readCommandNWait(Command.FADE_RATE, timeout, fresh)
 		
-	def GetVersionNumber(self, timeout=READ_TIMEOUT):
-		DBG('GetVersionNumber')
-		return self._readCommandNWait(Command.VERSION_NUMBER, timeout)
+	def GetVersionNumber(self, timeout=None, fresh=False):
+		self.log.debug('GetVersionNumber')
+		return self._readCommandNWait(Command.VERSION_NUMBER, timeout, fresh)
 		
-	def SetMusicModeWeights(self, treble, middle, bass, timeout=WRITE_TIMEOUT):
-		assert (isinstance(treble, int) and (treble >= 5) and (treble <= 25)), 'treble must be int between 5 and 25: %r' % treble
-		assert (isinstance(middle, int) and (middle >= 5) and (middle <= 25)), 'middle must be int between 5 and 25: %r' % middle
-		assert (isinstance(bass, int) and (bass >= 5) and (bass <= 25)), 'bass must be int between 5 and 25: %r' % bass
-		DBG('SetMusicModeWeights(%d, %d, %d)' % (treble, middle, bass))
-		return self._writeCommandNWait(Command.MUSIC_MODE_WEIGHTS, '%03d%03d%03d' % (treble, middle, bass), timeout)
-
-	def GetMusicModeWeights(self, timeout=READ_TIMEOUT):
-		DBG('GetMusicModeWeights')
-		return self._readCommandNWait(Command.MUSIC_MODE_WEIGHTS, timeout)
+	def SetMusicModeWeights(self, treble, middle, bass, timeout=WRITE_TIMEOUT, force=False, delivery=None):
+		weights = MusicModeWeights(treble, middle, bass)
+		frame = EncodeFrame(Command.MUSIC_MODE_WEIGHTS, CommandDirection.WRITE, weights)
+		self.log.debug('SetMusicModeWeights(%d, %d, %d)', treble, middle, bass)
+		return self._writeCommandNWait(Command.MUSIC_MODE_WEIGHTS, frame, timeout, weights, force, delivery)
+
+	def GetMusicModeWeights(self, timeout=None, fresh=False):
+		self.log.debug('GetMusicModeWeights')
+		return self._readCommandNWait(Command.MUSIC_MODE_WEIGHTS, timeout, fresh)
 		
 	def SetName(self, name):
 		assert isinstance(name, str), 'name must be string: %r' % name
-		DBG('SetName(%s)' % name)
-		return self.ds_name_char.write(('%s' % name).encode('UTF-8'))
+		self.log.debug('SetName(%s)', name)
+		with self._lock:
+			return self._communicate(lambda: self.ds_name_char.write(('%s' % name).encode('UTF-8')))
 
 	def GetName(self):
-		DBG('GetName')
-		return self.ds_name_char.read()
+		self.log.debug('GetName')
+		with self._lock:
+			return self._communicate(lambda: self.ds_name_char.read())
 
 if __name__ == '__main__':
+	# DS are recognised by advertisements, other devices are not connected
+	from .discovery import DreamScreenScanner
 	try:
 		print('[!] Scan')
 		conn = None
 		try:
-			devices = btle.Scanner().scan(1.0)
+			devices = DreamScreenScanner().Scan(1.0)
 		except btle.BTLEException as e:
 			sys.exit('Whoa1!!1 %s' % e.message)
-		print('Found %d devices' % len(devices))
+		print('Found %d DreamScreen devices' % len(devices))
 
 		for dev in devices:
-			print('Device %s (%s), RSSI=%d dB' % (dev.addr, dev.addrType, dev.rssi))
+			print('Device %s (%s), RSSI=%d dB' % (dev.address, dev.addrType, dev.rssi))
 			try:
 				if not dev.connectable:
 					print('[!] This device is not connectable. Skipping')
 					continue
 			
-				conn = btle.Peripheral(dev.addr)
-				name = conn.getServiceByUUID(btle.AssignedNumbers.generic_access).getCharacteristics(btle.AssignedNumbers.deviceName)[0].read().decode('UTF-8')
-				if (name != 'DreamScreen'):
-					conn.disconnect()
-					print('[!] This is not DreamScreen (%s). Skipping' % name)
-					continue
+				conn = btle.Peripheral(dev.address, dev.addrType)
 
 				print('DreamScreen connect success')
 
-				ds = DreamScreen(conn, DreamScreenDefaultDelegate())
+				ds = DreamScreen(conn, DreamScreenDefaultDelegate()).EnableReconnect(attempts=3)
 
 				print('DreamScreen name: %s' % ds.GetName().decode('UTF-8'))
 			
-				ds.GetMode()
+				print('DreamScreen mode: %s' % ds.GetMode())
 				ds.SetMode(Mode.IDENTIFY)
-				ds.GetBrightness()
-				ds.GetZone()
-				ds.GetAmblientColor()
-				ds.GetSaturation()
-				ds.GetSKU()
-				ds.GetCustomLEDCount()
-				ds.GetMusicModeType()
-				ds.GetMusicModeColor()
-				ds.GetVideoMinimumIntensity()
-				ds.GetAmbientShowType()
-				ds.GetFadeRate()
-				ds.GetVersionNumber()
-				ds.GetMusicModeWeights()
+				for request in ds.ReadCommands([command for command in Command if command != Command.MODE]):
+					if request.TimedOut():
+						print('[!] No response for %s' % request.command.name)
+					else:
+						print(FormatResponse(request.response))
 
 				conn.disconnect()
 			except btle.BTLEException as e:
-				assert (e.code == btle.BTLEException.DISCONNECTED), e.message
+				assert _isDisconnect(e), e.message
 				print('Whoa1!!1 %s' % e.message)
 				continue
 	except AssertionError as e:
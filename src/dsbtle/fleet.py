@@ -0,0 +1,152 @@
+''' Pool of DreamScreen devices '''
+import logging
+import threading
+from bluepy import btle
+from .dsbtle import *
+from .dsbtle import _isDisconnect
+from .discovery import DreamScreenScanner, SCAN_TIMEOUT
+
+_log = logging.getLogger('dsbtle.fleet')
+
+RECONNECT_INTERVAL = 5.0
+
+def _parallel(function, items):
+	'''Call function for every item in its own thread, return dict item -> result or raised exception'''
+	results = {}
+	def run(item):
+		try:
+			results[item] = function(item)
+		except Exception as e:
+			results[item] = e
+	threads = [threading.Thread(target=run, args=(item,)) for item in items]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return results
+
+class DreamScreenFleet:
+	'''Discovers DS devices, keeps them connected and runs commands on all of them in parallel'''
+	def __init__(self, delegateFactory=DreamScreenDefaultDelegate, reconnectInterval=RECONNECT_INTERVAL, handles=None):
+		_log.debug('DreamScreenFleet.__init__')
+		self.delegateFactory = delegateFactory
+		self.reconnectInterval = reconnectInterval
+		# Persistent GATT handles of all DS (HandleCache) or None
+		self.handles = handles
+		# Live connections, by MAC
+		self.devices = {}
+		# Address types of all known DS, by MAC; dropped ones are reconnected
+		self.addresses = {}
+		# Notifications of all DS, subscribe by addresses to get some of them
+		self.events = EventBus()
+		self._locks = {}
+		self._lock = threading.Lock()
+		self._reconnectThread = None
+		self._stopping = threading.Event()
+		# DreamScreenScanner, created by the first Discover
+		self.scanner = None
+
+	def _deviceLock(self, address):
+		with self._lock:
+			return self._locks.setdefault(address, threading.RLock())
+
+	def Connect(self, address, addrType=btle.ADDR_TYPE_PUBLIC):
+		'''Connect to DS at address and add it to the pool'''
+		_log.debug('DreamScreenFleet.Connect(%s)', address)
+		with self._deviceLock(address):
+			ds = self.devices.get(address)
+			if ds is not None:
+				return ds
+			conn = btle.Peripheral(address, addrType)
+			try:
+				ds = DreamScreen(conn, self.delegateFactory(), self.events, self.handles)
+			except:
+				conn.disconnect()
+				raise
+			with self._lock:
+				self.addresses[address] = addrType
+				self.devices[address] = ds
+			return ds
+
+	def Discover(self, timeout=SCAN_TIMEOUT):
+		'''Scan for DS advertisements, connect to all new DS in parallel (strongest signal first) and return list of their MACs'''
+		_log.debug('DreamScreenFleet.Discover(%s)', timeout)
+		if self.scanner is None:
+			self.scanner = DreamScreenScanner()
+		candidates = [advertisement for advertisement in self.scanner.Scan(timeout) if advertisement.connectable and (advertisement.address not in self.devices)]
+		results = _parallel(lambda advertisement: self.Connect(advertisement.address, advertisement.addrType), candidates)
+		return [advertisement.address for advertisement in candidates if isinstance(results[advertisement], DreamScreen)]
+
+	def Disconnect(self, address, forget=True):
+		_log.debug('DreamScreenFleet.Disconnect(%s)', address)
+		with self._lock:
+			ds = self.devices.pop(address, None)
+			if forget:
+				self.addresses.pop(address, None)
+		if ds is not None:
+			# Threads of the DS must not outlive its connection
+			ds.Close()
+
+	def Close(self):
+		self.StopReconnect()
+		for address in list(self.devices):
+			self.Disconnect(address)
+
+	def Run(self, function, addresses=None):
+		'''Call function(ds) for every connected DS in parallel, return dict MAC -> result or raised exception
+
+		Devices whose link was dropped (btle.BTLEDisconnectError) are dropped from the pool and reconnected in background.
+		'''
+		if addresses is None:
+			addresses = list(self.devices)
+		def run(address):
+			with self._deviceLock(address):
+				ds = self.devices.get(address)
+				if ds is None:
+					raise btle.BTLEDisconnectError('DreamScreen %s is not connected' % address)
+				try:
+					return function(ds)
+				except btle.BTLEException as e:
+					# GATT and management errors do not mean the link is gone
+					if _isDisconnect(e):
+						self.Disconnect(address, forget=False)
+					raise
+		return _parallel(run, addresses)
+
+	def Metrics(self):
+		'''Return list of Metrics of all connected DS, e.g. for FormatPrometheus'''
+		return [ds.metrics for ds in list(self.devices.values())]
+
+	def Call(self, name, *args, **kwargs):
+		'''Call DreamScreen method by name on every connected DS in parallel, e.g. Call('SetMode', Mode.VIDEO)'''
+		return self.Run(lambda ds: getattr(ds, name)(*args, **kwargs))
+
+	def Reconnect(self):
+		'''Reconnect all known DS, which are not connected now, return list of their MACs'''
+		with self._lock:
+			dropped = [(address, addrType) for (address, addrType) in self.addresses.items() if address not in self.devices]
+		results = _parallel(lambda item: self.Connect(*item), dropped)
+		return [address for (address, addrType) in dropped if isinstance(results[(address, addrType)], DreamScreen)]
+
+	def _reconnectLoop(self):
+		while not self._stopping.wait(self.reconnectInterval):
+			reconnected = self.Reconnect()
+			if reconnected:
+				_log.debug('DreamScreenFleet: reconnected %s', ', '.join(reconnected))
+
+	def StartReconnect(self):
+		'''Start background thread, which reconnects dropped DS every reconnectInterval seconds'''
+		if self._reconnectThread is not None:
+			return
+		self._stopping.clear()
+		self._reconnectThread = threading.Thread(target=self._reconnectLoop)
+		self._reconnectThread.daemon = True
+		self._reconnectThread.start()
+
+	def StopReconnect(self):
+		if self._reconnectThread is None:
+			return
+		self._stopping.set()
+		self._reconnectThread.join()
+		self._reconnectThread = None
@@ -0,0 +1,37 @@
+''' DreamScreen scenes: many settings, applied in one pass '''
+import logging
+from collections import namedtuple
+from .dsbtle import *
+
+_log = logging.getLogger('dsbtle.scene')
+
+# Fields of Scene and their commands in order of applying: settings first,
+# then the ones which switch mode of DS, and the mode itself at last
+SCENE_COMMANDS = (
+	('brightness', Command.BRIGHTNESS),
+	('zone', Command.ZONE),
+	('saturation', Command.SATURATION),
+	('fadeRate', Command.FADE_RATE),
+	('videoMinimumIntensity', Command.VIDEO_MINIMUM_INTENSITY),
+	('musicModeWeights', Command.MUSIC_MODE_WEIGHTS),
+	('musicModeColor', Command.MUSIC_MODE_COLOR),
+	('ambientColor', Command.AMBIENT_COLOR),
+	('musicModeType', Command.MUSIC_MODE_TYPE),
+	('ambientShowType', Command.AMBIENT_SHOW_TYPE),
+	('mode', Command.MODE),
+)
+
+# Look of DS; every field is a value as returned by Get* methods, or None to leave the setting as is
+Scene = namedtuple('Scene', [name for (name, command) in SCENE_COMMANDS])
+Scene.__new__.__defaults__ = (None,) * len(Scene._fields)
+
+def ApplyScene(ds, scene, timeout=None, confirm=True, force=False):
+	'''Write all fields of scene to ds without pauses, then confirm them together
+
+	Return dict of success by field name.
+	'''
+	assert isinstance(scene, Scene), 'scene must be Scene: %r' % scene
+	_log.debug('ApplyScene(%r)', scene)
+	writes = [(command, getattr(scene, name)) for (name, command) in SCENE_COMMANDS if getattr(scene, name) is not None]
+	results = ds.WriteCommands(writes, timeout, confirm, force)
+	return dict((name, results[command]) for (name, command) in SCENE_COMMANDS if command in results)
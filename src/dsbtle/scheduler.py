@@ -0,0 +1,253 @@
+''' Timed command programs for many DreamScreen devices '''
+import logging
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+from collections import OrderedDict
+from bluepy import btle
+from .dsbtle import *
+
+_log = logging.getLogger('dsbtle.scheduler')
+
+# Shortest interval between steps of a ramp, seconds
+RAMP_INTERVAL = 1.0
+# Events of one DS, which are due within this window, are written in one batch
+BATCH_WINDOW = 0.01
+
+def At(hour, minute=0, second=0, now=None):
+	'''Return time (as time.time()) of the next hour:minute:second of local time'''
+	if now is None:
+		now = time.time()
+	local = time.localtime(now)
+	due = time.mktime((local.tm_year, local.tm_mon, local.tm_mday, hour, minute, second, 0, 0, -1))
+	if due <= now:
+		# mktime normalises the day after the last one of month
+		due = time.mktime((local.tm_year, local.tm_mon, local.tm_mday + 1, hour, minute, second, 0, 0, -1))
+	return due
+
+def Ramp(command, end, at, duration, start=None, interval=RAMP_INTERVAL):
+	'''Generate events (time, command, value) of linear ramp from start to end (int or record of ints, e.g. RGB) over duration seconds
+
+	Steps are at least interval seconds apart and every one changes the value. start None - value of DS when the ramp begins.
+	'''
+	assert (duration >= 0), 'duration must not be negative: %r' % duration
+	assert (interval > 0), 'interval must be positive: %r' % interval
+	if start is None:
+		current = []
+		def read(ds):
+			current.append(ds._readCommandNWait(command, None, False))
+			# Nothing to write
+			return None
+		yield (at, command, read)
+		# Not read, if DS was not connected or the read failed
+		if (not current) or (current[0] is None):
+			_log.debug('Ramp(%s): start is unknown', command.name)
+			return
+		start = current[0]
+	starts = (start,) if isinstance(start, int) else tuple(start)
+	ends = (end,) if isinstance(end, int) else tuple(end)
+	assert (len(starts) == len(ends)), 'start and end must have the same fields: %r, %r' % (start, end)
+	distance = max(abs(last - first) for (first, last) in zip(starts, ends))
+	# Tolerance for division of floats, e.g. 0.3 / 0.1 < 3
+	steps = max(1, min(distance, int(duration / interval + 1e-9)))
+	for step in range(1, steps + 1):
+		progress = float(step) / steps
+		values = [int(round(first + (last - first) * progress)) for (first, last) in zip(starts, ends)]
+		yield (at + duration * progress, command, values[0] if isinstance(end, int) else type(end)(*values))
+
+class Scheduler(object):
+	'''Executes timed programs of commands for many DS from one priority queue, on one thread or event loop
+
+	Queue holds only the next event of every program, programs are advanced lazily.
+	'''
+	def __init__(self, devices, batchWindow=BATCH_WINDOW, confirm=False):
+		_log.debug('Scheduler.__init__')
+		# DreamScreen objects by MAC, e.g. devices of DreamScreenFleet
+		self.devices = devices
+		self.batchWindow = batchWindow
+		self.confirm = confirm
+		# Heap of (time, sequence, address, command, value, program)
+		self._queue = []
+		self._sequence = itertools.count()
+		self._condition = threading.Condition()
+		self._thread = None
+		self._stopping = False
+		# Wakes RunAsync from other threads
+		self._wake = None
+		self.executed = 0
+		# Events of DS, which were not connected, or failed to be written
+		self.missed = 0
+		self.failed = 0
+
+	def __len__(self):
+		'''Number of programs with pending events'''
+		return len(self._queue)
+
+	def _push(self, address, program):
+		'''Queue the next event of program, if any; caller holds the condition'''
+		try:
+			event = next(program, None)
+			if event is None:
+				return
+			(due, command, value) = event
+		except Exception as e:
+			# Broken program is dropped, the others go on
+			_log.debug('Scheduler: program of %s failed: %r', address, e)
+			self.failed += 1
+			return
+		heapq.heappush(self._queue, (due, next(self._sequence), address, command, value, program))
+
+	def _notify(self):
+		self._condition.notify()
+		if self._wake is not None:
+			self._wake()
+
+	def AddProgram(self, address, events):
+		'''Schedule program for DS of address: iterable of events (time, command, value) in order of time, e.g. list or Ramp
+
+		Value may be callable(ds), which returns value when the event is due (None - nothing to write).
+		'''
+		_log.debug('Scheduler.AddProgram(%s)', address)
+		with self._condition:
+			self._push(address, iter(events))
+			self._notify()
+		return self
+
+	def Add(self, address, at, command, value):
+		'''Schedule one command for DS of address at time (as time.time())'''
+		assert isinstance(command, Command), 'command must be Command: %r' % command
+		return self.AddProgram(address, [(at, command, value)])
+
+	def AddRamp(self, address, command, end, at, duration, start=None, interval=RAMP_INTERVAL):
+		'''Schedule Ramp for DS of address'''
+		assert isinstance(command, Command), 'command must be Command: %r' % command
+		return self.AddProgram(address, Ramp(command, end, at, duration, start, interval))
+
+	def Cancel(self, address=None, command=None):
+		'''Drop programs (of DS of address, whose next event is of command), return number of them'''
+		with self._condition:
+			kept = [entry for entry in self._queue if not (((address is None) or (entry[2] == address)) and ((command is None) or (entry[3] == command)))]
+			cancelled = len(self._queue) - len(kept)
+			heapq.heapify(kept)
+			self._queue = kept
+			self._notify()
+		return cancelled
+
+	def NextTime(self):
+		'''Return time of the next event or None'''
+		with self._condition:
+			return self._queue[0][0] if self._queue else None
+
+	def _popDue(self, now):
+		'''Remove events due by now from the queue, return them batched by address'''
+		batches = OrderedDict()
+		with self._condition:
+			while self._queue and (self._queue[0][0] <= now + self.batchWindow):
+				(due, sequence, address, command, value, program) = heapq.heappop(self._queue)
+				batches.setdefault(address, []).append((command, value, program))
+		return batches
+
+	def _advance(self, batches):
+		# Programs are advanced after their events are executed, so the next event may depend on the previous one
+		with self._condition:
+			for (address, events) in batches.items():
+				for (command, value, program) in events:
+					self._push(address, program)
+
+	def RunPending(self, now=None):
+		'''Execute all events due by now, batched per DS, return time of the next event or None'''
+		while True:
+			batches = self._popDue(time.time() if now is None else now)
+			if not batches:
+				return self.NextTime()
+			for (address, events) in batches.items():
+				self._execute(address, events)
+			self._advance(batches)
+
+	def _execute(self, address, events):
+		ds = self.devices.get(address)
+		if ds is None:
+			_log.debug('Scheduler: %s is not connected', address)
+			self.missed += len(events)
+			return
+		# The latest value of every command in the batch, in order of writing
+		writes = OrderedDict()
+		for (command, value, program) in events:
+			if callable(value):
+				try:
+					value = value(ds)
+				except Exception as e:
+					_log.debug('Scheduler: %s: %s: %r', address, command.name, e)
+					self.failed += 1
+					continue
+			if value is not None:
+				writes.pop(command, None)
+				writes[command] = value
+		try:
+			if writes:
+				ds.WriteCommands(list(writes.items()), confirm=self.confirm)
+			self.executed += len(writes)
+		except (btle.BTLEException, AssertionError) as e:
+			_log.debug('Scheduler: %s: %s', address, e)
+			self.failed += len(writes)
+
+	def Run(self):
+		'''Execute events on this thread until Stop, sleeping until the next one is due or a program is added'''
+		_log.debug('Scheduler.Run')
+		self._stopping = False
+		while True:
+			self.RunPending()
+			with self._condition:
+				if self._stopping:
+					return
+				due = self._queue[0][0] if self._queue else None
+				if (due is None) or (due > time.time() + self.batchWindow):
+					self._condition.wait(None if due is None else due - time.time())
+
+	async def RunAsync(self):
+		'''Execute events from the running event loop until Stop; commands are written by its executor, so the loop is not blocked'''
+		_log.debug('Scheduler.RunAsync')
+		loop = asyncio.get_event_loop()
+		wake = asyncio.Event()
+		self._stopping = False
+		self._wake = lambda: loop.call_soon_threadsafe(wake.set)
+		try:
+			while not self._stopping:
+				wake.clear()
+				batches = self._popDue(time.time())
+				if batches:
+					for (address, events) in batches.items():
+						await loop.run_in_executor(None, self._execute, address, events)
+					self._advance(batches)
+					continue
+				due = self.NextTime()
+				try:
+					await asyncio.wait_for(wake.wait(), None if due is None else max(0.0, due - time.time()))
+				except asyncio.TimeoutError:
+					pass
+		finally:
+			self._wake = None
+
+	def Start(self):
+		'''Start background thread, which runs the scheduler'''
+		if self._thread is not None:
+			return self
+		self._stopping = False
+		self._thread = threading.Thread(target=self.Run)
+		self._thread.daemon = True
+		self._thread.start()
+		return self
+
+	def Stop(self):
+		'''Stop Run, RunAsync or background thread; queued programs are kept'''
+		_log.debug('Scheduler.Stop')
+		with self._condition:
+			self._stopping = True
+			self._notify()
+		thread = self._thread
+		self._thread = None
+		if (thread is not None) and (thread is not threading.current_thread()):
+			thread.join()
+		return self
@@ -0,0 +1,231 @@
+''' In-process DreamScreen peripheral for benchmarking and testing without hardware '''
+import heapq
+import random
+import threading
+import time
+from bluepy import btle
+from .dsbtle import *
+
+# Attribute handles of the simulated GATT table
+GAP_SERVICE_HANDLES = (0x0001, 0x0003)
+DEVICE_NAME_HANDLE = 0x0003
+DS_SERVICE_HANDLES = (0x0020, 0x0027)
+COMMAND_HANDLE = 0x0022
+RESPONSE_HANDLE = 0x0024
+RESPONSE_CCCD_HANDLE = 0x0025
+NAME_HANDLE = 0x0027
+
+DEFAULT_MTU = 23
+NOTIFICATION_LENGTH = 20
+
+# State of a new simulated DS
+DEFAULT_STATE = {
+	Command.MODE: Mode.VIDEO,
+	Command.BRIGHTNESS: 100,
+	Command.ZONE: Zone(True, True, True, True),
+	Command.AMBIENT_COLOR: RGB(255, 255, 255),
+	Command.SATURATION: RGB(255, 255, 255),
+	Command.SKU: SKU.CLASSIC,
+	Command.CUSTOM_LED_COUNT: CustomLEDCount(12, 20, CustomLEDMode.RIGHT_COUNTER_CLOCKWISE),
+	Command.MUSIC_MODE_TYPE: MusicModeType.TOP_N_BOTTOM_TO_MIDDLE,
+	Command.MUSIC_MODE_COLOR: MusicModeColors(MusicModeColor.RED, MusicModeColor.GREEN, MusicModeColor.BLUE),
+	Command.VIDEO_MINIMUM_INTENSITY: RGB(0, 0, 0),
+	Command.AMBIENT_SHOW_TYPE: AmbientShowType.COLORS,
+	Command.FADE_RATE: 10,
+	Command.VERSION_NUMBER: VersionNumber(1, 6),
+	Command.MUSIC_MODE_WEIGHTS: MusicModeWeights(15, 15, 15),
+}
+
+# Writes, which switch mode of DS
+_MODE_SWITCHES = {
+	Command.AMBIENT_COLOR: Mode.AMBIENT_STATIC,
+	Command.MUSIC_MODE_TYPE: Mode.MUSIC,
+	Command.AMBIENT_SHOW_TYPE: Mode.AMBIENT_SHOW,
+}
+
+class SimulatedDreamScreen(btle.Peripheral):
+	'''Simulated DS peripheral: 0000ff60 service with ff61 command, ff62 response and ff63 name characteristics
+
+	Responds to read-commands with notifications after *latency* +/- *jitter* seconds, applies write-commands to its state.
+	Every frame is lost with probability *loss*; written frames longer than MTU - 3 bytes are truncated.
+	GATT discovery requests and reads take *latency* seconds each.
+	'''
+	def __init__(self, addr='00:00:00:00:00:00', state=None, name='DreamScreen', latency=0.02, jitter=0.0, loss=0.0, mtu=DEFAULT_MTU, seed=None):
+		btle.Peripheral.__init__(self)
+		self.addr = addr
+		self.addrType = btle.ADDR_TYPE_PUBLIC
+		self.state = dict(DEFAULT_STATE)
+		if state is not None:
+			self.state.update(state)
+		self.name = name
+		self.latency = latency
+		self.jitter = jitter
+		self.loss = loss
+		self.mtu = mtu
+		self.random = random.Random(seed)
+		self.connected = True
+		self.notificationsEnabled = False
+		# Counters of simulated traffic
+		self.received = 0
+		self.sent = 0
+		self.lost = 0
+		self.gattRequests = 0
+		self._notifications = []
+		self._sequence = 0
+		self._lastDelivery = 0.0
+		self._condition = threading.Condition()
+
+		self._services = [
+			btle.Service(self, btle.AssignedNumbers.generic_access, GAP_SERVICE_HANDLES[0], GAP_SERVICE_HANDLES[1]),
+			btle.Service(self, DS_SERVICE_UUID, DS_SERVICE_HANDLES[0], DS_SERVICE_HANDLES[1]),
+		]
+		props = btle.Characteristic.props
+		self._characteristics = [
+			btle.Characteristic(self, btle.AssignedNumbers.deviceName, DEVICE_NAME_HANDLE - 1, props['READ'], DEVICE_NAME_HANDLE),
+			btle.Characteristic(self, DS_COMMAND_UUID, COMMAND_HANDLE - 1, props['WRITE'] | props['WRITE_NO_RESP'], COMMAND_HANDLE),
+			btle.Characteristic(self, DS_RESPONSE_UUID, RESPONSE_HANDLE - 1, props['NOTIFY'], RESPONSE_HANDLE),
+			btle.Characteristic(self, DS_NAME_UUID, NAME_HANDLE - 1, props['READ'] | props['WRITE'], NAME_HANDLE),
+		]
+		self._descriptors = [btle.Descriptor(self, characteristic.uuid, characteristic.valHandle) for characteristic in self._characteristics]
+		self._descriptors.append(btle.Descriptor(self, btle.AssignedNumbers.client_characteristic_configuration, RESPONSE_CCCD_HANDLE))
+		self._descriptors.sort(key=lambda descriptor: descriptor.handle)
+
+	def _checkConnected(self):
+		if not self.connected:
+			raise btle.BTLEDisconnectError('Device disconnected')
+
+	def _gattRequest(self):
+		'''Wait for response to ATT request'''
+		self._checkConnected()
+		self.gattRequests += 1
+		time.sleep(self.latency)
+
+	def _lose(self):
+		if self.loss and (self.random.random() < self.loss):
+			self.lost += 1
+			return True
+		return False
+
+	def connect(self, addr=None, addrType=btle.ADDR_TYPE_PUBLIC, iface=None):
+		self.connected = True
+		self.notificationsEnabled = False
+
+	def disconnect(self):
+		self.connected = False
+		with self._condition:
+			self._notifications = []
+			self._condition.notify_all()
+
+	def getState(self):
+		return 'conn' if self.connected else 'disc'
+
+	def setMTU(self, mtu):
+		self._checkConnected()
+		self.mtu = mtu
+
+	def getServices(self):
+		self._gattRequest()
+		return list(self._services)
+
+	def getServiceByUUID(self, uuidVal):
+		self._gattRequest()
+		uuid = btle.UUID(uuidVal)
+		for service in self._services:
+			if service.uuid == uuid:
+				return service
+		raise btle.BTLEGattError('Service %s not found' % uuid)
+
+	def getCharacteristics(self, startHnd=1, endHnd=0xFFFF, uuid=None):
+		self._gattRequest()
+		return [characteristic for characteristic in self._characteristics
+			if (startHnd <= characteristic.handle <= endHnd) and ((uuid is None) or (characteristic.uuid == btle.UUID(uuid)))]
+
+	def getDescriptors(self, startHnd=1, endHnd=0xFFFF):
+		self._gattRequest()
+		return [descriptor for descriptor in self._descriptors if startHnd <= descriptor.handle <= endHnd]
+
+	def readCharacteristic(self, handle):
+		self._gattRequest()
+		if handle in (DEVICE_NAME_HANDLE, NAME_HANDLE):
+			return self.name.encode('UTF-8')
+		raise btle.BTLEGattError('Handle 0x%04x is not readable' % handle)
+
+	def writeCharacteristic(self, handle, val, withResponse=False):
+		self._checkConnected()
+		if withResponse:
+			# Wait for ATT write response
+			time.sleep(self.latency)
+		if handle == RESPONSE_CCCD_HANDLE:
+			self.notificationsEnabled = (val[0:1] == b'\1')
+		elif handle == NAME_HANDLE:
+			self.name = val.decode('UTF-8')
+		elif handle == COMMAND_HANDLE:
+			if withResponse or not self._lose():
+				self._receiveCommand(val[:self.mtu - 3])
+		else:
+			raise btle.BTLEGattError('Handle 0x%04x is not writable' % handle)
+		return {'rsp': ['wr']}
+
+	def _receiveCommand(self, frame):
+		self.received += 1
+		try:
+			frame = frame.decode('UTF-8')
+			command = Command(frame[1])
+			direction = CommandDirection(frame[2])
+		except (UnicodeDecodeError, IndexError, ValueError):
+			return
+		if frame[0] != COMMAND_CHAR:
+			return
+		if direction == CommandDirection.READ:
+			self._notify(command, CommandDirection.READ)
+		elif direction == CommandDirection.WRITE:
+			try:
+				value = DecodeArgument(command, frame[3:])
+			except AssertionError:
+				return
+			self._apply(command, value)
+
+	def _apply(self, command, value):
+		if command == Command.VERSION_NUMBER:
+			return
+		if (command == Command.MODE) and (value == Mode.IDENTIFY):
+			# DS lights blue for a few seconds and returns to the previous mode
+			return
+		self.state[command] = value
+		if command in _MODE_SWITCHES:
+			self.state[Command.MODE] = _MODE_SWITCHES[command]
+
+	def _notify(self, command, direction):
+		if (not self.notificationsEnabled) or self._lose():
+			return
+		data = EncodeFrame(command, direction, self.state[command]) + b'\r'
+		delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+		with self._condition:
+			# Link delivers notifications in order
+			self._lastDelivery = max(time.time() + delay, self._lastDelivery)
+			self._sequence += 1
+			heapq.heappush(self._notifications, (self._lastDelivery, self._sequence, data.ljust(NOTIFICATION_LENGTH, b'\0')))
+			self._condition.notify_all()
+
+	def PressButton(self, command, value):
+		'''Simulate change of setting by DS buttons: apply value and send user notification'''
+		self._apply(command, value)
+		self._notify(command, CommandDirection.USER)
+
+	def waitForNotifications(self, timeout):
+		deadline = time.time() + timeout
+		with self._condition:
+			while True:
+				self._checkConnected()
+				now = time.time()
+				if self._notifications and (self._notifications[0][0] <= now):
+					data = heapq.heappop(self._notifications)[2]
+					break
+				if now >= deadline:
+					return False
+				wake = deadline if not self._notifications else min(deadline, self._notifications[0][0])
+				self._condition.wait(wake - now)
+		self.sent += 1
+		if self.delegate is not None:
+			self.delegate.handleNotification(RESPONSE_HANDLE, data)
+		return True
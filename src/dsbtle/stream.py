@@ -0,0 +1,58 @@
+''' Real-time streaming of ambient colors to DreamScreen '''
+import logging
+import time
+from collections import namedtuple
+from .dsbtle import *
+
+_log = logging.getLogger('dsbtle.stream')
+
+STREAM_FPS = 20.0
+
+# Result of streaming: frames taken from the source, sent to DS, dropped because the link was behind schedule,
+# skipped because equal to the previous one; duration in seconds and achieved rate of shown frames per second
+StreamStats = namedtuple('StreamStats', 'frames sent dropped skipped duration fps')
+
+# Commands with RGB argument, which can be streamed
+STREAM_COMMANDS = (Command.AMBIENT_COLOR, Command.SATURATION)
+
+def StreamColors(ds, frames, fps=STREAM_FPS, stop=None, command=Command.AMBIENT_COLOR, checked=True):
+	'''Send RGB frames from iterable to ds as write-commands (AMBIENT_COLOR or SATURATION) without response, at fixed rate fps
+
+	Frame is dropped if its time slot has passed already (the link is saturated), but never two in a row. Streaming ends with the frames,
+	or when stop (threading.Event) is set. checked False skips validation of frames from trusted source, e.g. Frames of transition.
+	Return StreamStats.
+	'''
+	assert (fps > 0), 'fps must be positive: %r' % fps
+	assert command in STREAM_COMMANDS, 'command must be AMBIENT_COLOR or SATURATION: %r' % command
+	_log.debug('StreamColors(%s)', fps)
+	period = 1.0 / fps
+	encode = EncodeFrame if checked else EncodeFrameUnchecked
+	count = sent = dropped = skipped = 0
+	last = None
+	late = False
+	started = time.time()
+	for frame in frames:
+		if (stop is not None) and stop.is_set():
+			break
+		slot = started + count * period
+		count += 1
+		# Frame is stale after its slot; the next one is sent anyway, so slow source still gets through
+		if (time.time() > slot + period) and not late:
+			late = True
+			dropped += 1
+			continue
+		late = False
+		color = RGB(*[int(component) for component in frame])
+		# Process notifications while waiting for the slot
+		ds._pause(slot)
+		if color == last:
+			skipped += 1
+			continue
+		ds._transmitFrame(command, CommandDirection.WRITE, encode(command, CommandDirection.WRITE, color))
+		last = color
+		sent += 1
+	duration = time.time() - started
+	if last is not None:
+		ds.cache.Written(command, last)
+		ds._desire(command, last)
+	return StreamStats(count, sent, dropped, skipped, duration, (count - dropped) / duration if duration > 0 else 0.0)
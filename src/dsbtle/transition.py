@@ -0,0 +1,142 @@
+''' Precomputed color transitions for DreamScreen (requires numpy) '''
+import logging
+from enum import Enum
+import numpy
+from .dsbtle import *
+
+_log = logging.getLogger('dsbtle.transition')
+
+class Interpolation(Enum):
+	RGB = 'rgb'  # Straight interpolation of sRGB components
+	LINEAR = 'linear'  # Gamma-correct: interpolation of linear light
+	HSV = 'hsv'  # Hue by shortest arc, saturation and value
+	LAB = 'lab'  # CIE L*a*b*, perceptually uniform
+
+# Easings: map progress array (0..1) to eased progress
+def EaseLinear(t):
+	return t
+
+def EaseIn(t):
+	return t * t
+
+def EaseOut(t):
+	return t * (2.0 - t)
+
+def EaseInOut(t):
+	return t * t * (3.0 - 2.0 * t)
+
+def EaseSine(t):
+	return 0.5 - 0.5 * numpy.cos(numpy.pi * t)
+
+# sRGB (D65) to CIE XYZ
+_RGB_TO_XYZ = numpy.array([
+	[0.4124564, 0.3575761, 0.1804375],
+	[0.2126729, 0.7151522, 0.0721750],
+	[0.0193339, 0.1191920, 0.9503041]])
+_XYZ_TO_RGB = numpy.linalg.inv(_RGB_TO_XYZ)
+_WHITE = _RGB_TO_XYZ.sum(axis=1)
+_LAB_EPSILON = 216.0 / 24389
+_LAB_KAPPA = 24389.0 / 27
+
+def _toLinear(rgb):
+	'''sRGB components 0..1 to linear light'''
+	return numpy.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+
+def _fromLinear(rgb):
+	rgb = numpy.clip(rgb, 0.0, 1.0)
+	return numpy.where(rgb <= 0.0031308, rgb * 12.92, 1.055 * rgb ** (1 / 2.4) - 0.055)
+
+def _toLab(rgb):
+	xyz = _toLinear(rgb).dot(_RGB_TO_XYZ.T) / _WHITE
+	f = numpy.where(xyz > _LAB_EPSILON, numpy.cbrt(xyz), (_LAB_KAPPA * xyz + 16) / 116)
+	return numpy.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+def _fromLab(lab):
+	fy = (lab[..., 0] + 16) / 116
+	f = numpy.stack([fy + lab[..., 1] / 500, fy, fy - lab[..., 2] / 200], axis=-1)
+	xyz = numpy.where(f ** 3 > _LAB_EPSILON, f ** 3, (116 * f - 16) / _LAB_KAPPA)
+	return _fromLinear((xyz * _WHITE).dot(_XYZ_TO_RGB.T))
+
+def _toHSV(rgb):
+	value = rgb.max(axis=-1)
+	delta = value - rgb.min(axis=-1)
+	saturation = numpy.where(value > 0, delta / numpy.where(value > 0, value, 1), 0.0)
+	safe = numpy.where(delta > 0, delta, 1)
+	(r, g, b) = (rgb[..., 0], rgb[..., 1], rgb[..., 2])
+	hue = numpy.where(value == r, (g - b) / safe, numpy.where(value == g, 2 + (b - r) / safe, 4 + (r - g) / safe))
+	hue = numpy.where(delta > 0, (hue / 6) % 1.0, 0.0)
+	return numpy.stack([hue, saturation, value], axis=-1)
+
+def _fromHSV(hsv):
+	(hue, saturation, value) = (hsv[..., 0] % 1.0 * 6, hsv[..., 1], hsv[..., 2])
+	sector = numpy.floor(hue).astype(int) % 6
+	fraction = hue - numpy.floor(hue)
+	p = value * (1 - saturation)
+	q = value * (1 - saturation * fraction)
+	t = value * (1 - saturation * (1 - fraction))
+	r = numpy.choose(sector, [value, q, p, p, t, value])
+	g = numpy.choose(sector, [t, value, value, q, p, p])
+	b = numpy.choose(sector, [p, p, t, value, value, q])
+	return numpy.stack([r, g, b], axis=-1)
+
+def _interpolate(start, end, progress, interpolation):
+	'''Colors 0..1 between start and end (arrays of 3) at progress (column array)'''
+	if interpolation == Interpolation.RGB:
+		return start + (end - start) * progress
+	if interpolation == Interpolation.LINEAR:
+		(start, end) = (_toLinear(start), _toLinear(end))
+		return _fromLinear(start + (end - start) * progress)
+	if interpolation == Interpolation.LAB:
+		(start, end) = (_toLab(start), _toLab(end))
+		return _fromLab(start + (end - start) * progress)
+	(start, end) = (_toHSV(start), _toHSV(end))
+	# Hue of grey is undefined: take it from the other end
+	if start[1] == 0:
+		start[0] = end[0]
+	if end[1] == 0:
+		end[0] = start[0]
+	delta = end - start
+	delta[0] = (delta[0] + 0.5) % 1.0 - 0.5
+	return _fromHSV(start + delta * progress)
+
+def Quantize(colors):
+	'''Round colors 0..1 to uint8 array of protocol components 0..255'''
+	return numpy.rint(numpy.clip(colors, 0.0, 1.0) * 255).astype(numpy.uint8)
+
+def Transition(start, end, frames, interpolation=Interpolation.LINEAR, easing=EaseLinear):
+	'''Return uint8 array (frames x 3) of colors from start to end (RGB, both included)'''
+	assert isinstance(frames, int) and (frames >= 1), 'frames must be positive int: %r' % frames
+	assert isinstance(interpolation, Interpolation), 'interpolation must be Interpolation: %r' % interpolation
+	_log.debug('Transition(%s, %s, %s, %s)', start, end, frames, interpolation)
+	progress = numpy.linspace(0.0, 1.0, frames) if frames > 1 else numpy.ones(1)
+	progress = numpy.clip(easing(progress), 0.0, 1.0)[:, numpy.newaxis]
+	start = numpy.asarray(start, dtype=float) / 255
+	end = numpy.asarray(end, dtype=float) / 255
+	return Quantize(_interpolate(start, end, progress, interpolation))
+
+def Transitions(colors, frames, interpolation=Interpolation.LINEAR, easing=EaseLinear):
+	'''Return uint8 array of colors passing all colors (keyframes) in order, frames per each transition between them'''
+	assert len(colors) >= 2, 'colors must have at least 2 items: %r' % (colors,)
+	parts = [Transition(colors[0], colors[1], frames, interpolation, easing)]
+	for (start, end) in zip(colors[1:], colors[2:]):
+		# Start of the next transition is the end of the previous one
+		parts.append(Transition(start, end, frames + 1, interpolation, easing)[1:])
+	return numpy.concatenate(parts)
+
+def RemoveDuplicates(frames):
+	'''Return (colors, counts): frames without consecutive duplicates and number of frames each color lasts'''
+	frames = numpy.asarray(frames, dtype=numpy.uint8)
+	if not len(frames):
+		return (frames, numpy.zeros(0, dtype=int))
+	changes = numpy.flatnonzero(numpy.any(frames[1:] != frames[:-1], axis=1)) + 1
+	starts = numpy.concatenate([[0], changes])
+	return (frames[starts], numpy.diff(numpy.append(starts, len(frames))))
+
+def Frames(colors, counts=None):
+	'''Generate RGB frames from uint8 array of colors, every color repeated by counts, e.g. for StreamColors'''
+	if counts is None:
+		counts = numpy.ones(len(colors), dtype=int)
+	for (color, count) in zip(colors.tolist(), counts.tolist()):
+		color = RGB(*color)
+		for i in range(count):
+			yield color